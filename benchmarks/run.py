@@ -0,0 +1,244 @@
+""" Synthetic benchmarks for dkdep.
+
+Generates a manifest of --versions versions x --packages packages and --repos local bare git repos
+(each with --history commits) that act as the "origin" (over file://) and times:
+
+    manifest    Manifest.load (with and without the manifest cache), Manifest.save,
+                Deployment.new_version and Deployment.versions_with_package
+    git         Manifest.checkout (fresh, already checked out and from a warm mirror cache) and
+                Manifest.commitversion
+    aws         AWSClient instance lookups, ensure_instances and reconcile_ingress against a
+                StubBackend holding --instances instances and --groups security groups
+
+Each benchmark is run --repeat times and the best, median and mean times are reported as json (to
+stdout or --output) so that runs can be compared.  Nothing outside a temp dir is touched.
+
+    python benchmarks/run.py [--only manifest,git,aws] [--repeat N] [--output results.json]
+"""
+import os, sys, io, json, time, shutil, argparse, platform, tempfile, statistics, subprocess, contextlib
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOTDIR)
+
+import synthetic
+from dkdeputils.models import Manifest, yamldump
+from dkdeputils.mirrors import MirrorCache
+from dkdeputils.aws import AWSClient, StubBackend, IngressRule, aws_has_tag
+
+SUITES = ["manifest", "git", "aws"]
+
+class Bench:
+    def __init__(self, repeat, verbose=False):
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = []
+
+    def measure(self, suite, name, func, setup=None, **params):
+        """ Times func(setup()) repeat times (setup is not timed).  Output printed by func is
+        swallowed unless verbose.  If func returns a dict it is recorded with the result.  If setup
+        or func fail (dkdep exits on most errors) the benchmark is recorded as failed with the error
+        and the output it printed. """
+        times, extra = [], None
+        for _ in range(self.repeat):
+            out = sys.stdout if self.verbose else io.StringIO()
+            try:
+                with contextlib.redirect_stdout(out):
+                    arg = setup() if setup else None
+                    start = time.perf_counter()
+                    value = func(arg)
+                    elapsed = time.perf_counter() - start
+            except (Exception, SystemExit) as exc:
+                error = f"{type(exc).__name__}: {exc}"
+                result = {"suite": suite, "name": name, "params": params, "failed": True, "error": error}
+                if not self.verbose: result["output"] = out.getvalue()[-2000:]
+                self.results.append(result)
+                print(f"  {suite}.{name:32s} FAILED {error}", file=sys.stderr)
+                return result
+            times.append(elapsed)
+            if isinstance(value, dict): extra = value
+        result = {"suite": suite, "name": name, "params": params,
+                  "best_s": min(times), "median_s": statistics.median(times),
+                  "mean_s": statistics.mean(times), "runs_s": times}
+        if extra: result["extra"] = extra
+        self.results.append(result)
+        print(f"  {suite}.{name:32s} best {min(times)*1000:10.2f}ms  median {statistics.median(times)*1000:10.2f}ms", file=sys.stderr)
+        return result
+
+def bench_manifest(bench, workdir, args):
+    params = {"versions": args.versions, "packages": args.packages}
+    path = os.path.join(workdir, "manifest")
+    with open(path, "w") as outfile:
+        outfile.write(yamldump(synthetic.manifest_json("bench", args.versions, args.packages, uncommitted=False)))
+    cachedir = os.path.join(workdir, "manifestcache")
+    Manifest(path, cachedir)    # populates the cache
+
+    bench.measure("manifest", "load_uncached", lambda _: Manifest(path, None), **params)
+    bench.measure("manifest", "load_cached", lambda _: Manifest(path, cachedir), **params)
+    bench.measure("manifest", "save", lambda m: m.save(), setup=lambda: Manifest(path, None), **params)
+    bench.measure("manifest", "new_version", lambda m: m.deployment.new_version("vnew"),
+                  setup=lambda: Manifest(path, cachedir), **params)
+    bench.measure("manifest", "versions_with_package", lambda m: {"found": len(m.deployment.versions_with_package("pkg0"))},
+                  setup=lambda: Manifest(path, cachedir), **params)
+
+def bench_git(bench, workdir, args):
+    params = {"repos": args.repos, "history": args.history, "filesize": args.filesize, "jobs": args.jobs}
+    origins = {}
+    for r in range(args.repos):
+        origin = os.path.join(workdir, "origins", f"pkg{r}.git")
+        os.makedirs(os.path.dirname(origin), exist_ok=True)
+        origins[f"pkg{r}"] = (origin, synthetic.make_origin(origin, args.history, args.filesize))
+    path = os.path.join(workdir, "gitmanifest")
+    with open(path, "w") as outfile:
+        outfile.write(yamldump({"name": "bench", "versions": [{"name": "v0", "versiontag": "v0", "packages": [
+            {"name": name, "repo_url": url, "versiontag": "main"} for name,(_,url) in origins.items()]}]}))
+    cachedir = os.path.join(workdir, "gitmanifestcache")
+    repodir = os.path.join(workdir, "repos")
+
+    def fresh_repodir():
+        shutil.rmtree(repodir, ignore_errors=True)
+        return Manifest(path, cachedir)
+    bench.measure("git", "checkout_fresh", lambda m: m.checkout("v0", repodir, jobs=args.jobs), setup=fresh_repodir, **params)
+    bench.measure("git", "checkout_existing", lambda m: m.checkout("v0", repodir, jobs=args.jobs),
+                  setup=lambda: Manifest(path, cachedir), **params)
+    mirrors = MirrorCache(os.path.join(workdir, "mirrors"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        Manifest(path, cachedir).checkout("v0", repodir, jobs=args.jobs, mirrors=mirrors)   # populates the mirrors
+    def fresh_with_mirrors():
+        m = fresh_repodir()
+        return m, MirrorCache(mirrors.root)
+    bench.measure("git", "checkout_fresh_from_mirrors", lambda mm: mm[0].checkout("v0", repodir, jobs=args.jobs, mirrors=mm[1]),
+                  setup=fresh_with_mirrors, **params)
+
+    # Each run commits a new version in which half of the repos have a new commit on origin
+    counter = [args.history]
+    def new_changes():
+        m = Manifest(path, cachedir)
+        if not m.deployment.uncommitted_version:
+            for name, (origin, _) in list(origins.items())[::2]:
+                synthetic.push_commit(origin, counter[0], args.filesize)
+                counter[0] += 1
+            m.newversion(f"v{counter[0]}")
+        return m
+    bench.measure("git", "commitversion", lambda m: m.commitversion(repodir, jobs=args.jobs), setup=new_changes, **params)
+
+def bench_aws(bench, workdir, args):
+    params = {"instances": args.instances, "groups": args.groups}
+    instances = [{"InstanceId": f"i-{n:08x}", "State": {"Name": "running"},
+                  "Tags": [{"Key": "Name", "Value": f"host{n}"}]} for n in range(args.instances)]
+    groups = [{"GroupId": f"sg-{n:08x}", "IpPermissions": [
+        {"IpProtocol": "tcp", "FromPort": 22, "ToPort": 22, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]}]} for n in range(args.groups)]
+    launched = [0]
+
+    def describe_instances(MaxResults=None, NextToken=None, InstanceIds=None, Filters=None):
+        if InstanceIds:
+            return {"Reservations": [{"Instances": [i for i in instances if i["InstanceId"] in InstanceIds]}]}
+        start = int(NextToken or 0)
+        end = start + MaxResults if MaxResults else len(instances)
+        resp = {"Reservations": [{"Instances": instances[start:end]}]}
+        if end < len(instances): resp["NextToken"] = str(end)
+        return resp
+    def run_instances(MinCount=1, **params):
+        launched[0] += MinCount
+        return {"Instances": [{"InstanceId": f"i-new{launched[0]+n}", "State": {"Name": "running"}} for n in range(MinCount)]}
+    def describe_groups(Filters=None, MaxResults=None, NextToken=None):
+        ids = set(next((f["Values"] for f in Filters or [] if f["Name"] == "group-id"), []))
+        return {"SecurityGroups": [g for g in groups if not ids or g["GroupId"] in ids]}
+    responses = {
+        ("ec2", "DescribeInstances"): describe_instances,
+        ("ec2", "RunInstances"): run_instances,
+        ("ec2", "DescribeImages"): {"Images": [{"BlockDeviceMappings": [{"DeviceName": "/dev/sda1"}]}]},
+        ("ec2", "DescribeSecurityGroups"): describe_groups,
+    }
+    def client(cache_ttl=0):
+        return AWSClient(None, backend=StubBackend(responses), cache_ttl=cache_ttl)
+    def calls(c): return {"calls": len(c.backend.calls)}
+
+    last = f"host{args.instances - 1}"
+    def find_last(c):
+        assert c.find_instance(lambda inst: aws_has_tag(inst, "Name", last))
+        return calls(c)
+    bench.measure("aws", "find_instance_last", find_last, setup=client, **params)
+    def cached_client():
+        c = client(60)
+        find_last(c)
+        c.backend.calls.clear()
+        return c
+    bench.measure("aws", "find_instance_last_cached", find_last, setup=cached_client, **params)
+
+    # Half of the specs match existing instances, the other half are launched
+    config = {"ImageId": "ami-bench", "InstanceType": "t3.micro"}
+    specs = [((lambda inst, name=f"host{n}": aws_has_tag(inst, "Name", name)), config) for n in range(0, args.instances, max(1, args.instances // 10))]
+    specs += [((lambda inst, name=f"missing{n}": aws_has_tag(inst, "Name", name)),
+               dict(config, TagSpecifications=[{"ResourceType": "instance", "Tags": [{"Key": "Name", "Value": f"missing{n}"}]}]))
+              for n in range(len(specs))]
+    def ensure(c):
+        c.ensure_instances(specs)
+        return calls(c)
+    bench.measure("aws", "ensure_instances", ensure, setup=client, specs=len(specs), **params)
+
+    rules = {g["GroupId"]: [IngressRule([22, 80, 443]), IngressRule([80, 443], cidrs=["::/0"])] for g in groups}
+    def reconcile(c):
+        c.reconcile_ingress(rules, jobs=args.jobs)
+        return calls(c)
+    bench.measure("aws", "reconcile_ingress", reconcile, setup=client, **params)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOTDIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the synthetic dkdep benchmarks")
+    parser.add_argument("--only", default=",".join(SUITES), help="Comma separated suites to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--versions", type=int, default=500, help="Versions in the synthetic manifest")
+    parser.add_argument("--packages", type=int, default=30, help="Packages per version in the synthetic manifest")
+    parser.add_argument("--repos", type=int, default=8, help="Git repos to check out and commit")
+    parser.add_argument("--history", type=int, default=50, help="Commits in each git repo")
+    parser.add_argument("--filesize", type=int, default=4096, help="Bytes written by each commit")
+    parser.add_argument("--instances", type=int, default=2000, help="Instances behind the stub aws backend")
+    parser.add_argument("--groups", type=int, default=50, help="Security groups behind the stub aws backend")
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--output", help="Write the json results here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the benchmarked calls")
+    parser.add_argument("--keep", action="store_true", help="Keep (and print) the temp dir")
+    args = parser.parse_args(argv)
+
+    suites = [s.strip() for s in args.only.split(",") if s.strip()]
+    unknown = [s for s in suites if s not in SUITES]
+    if unknown:
+        parser.error(f"Unknown suite(s): {', '.join(unknown)}")
+
+    # commitversion tags (git tag -a) in the checked out repos which needs an identity
+    os.environ.update(synthetic.GIT_ENV)
+    bench = Bench(args.repeat, args.verbose)
+    workdir = tempfile.mkdtemp(prefix="dkdep-bench-")
+    try:
+        for suite in suites:
+            print(f"{suite}:", file=sys.stderr)
+            os.makedirs(os.path.join(workdir, suite))
+            try:
+                globals()[f"bench_{suite}"](bench, os.path.join(workdir, suite), args)
+            except (Exception, SystemExit) as exc:
+                # Preparing the suite failed, the benchmarks already run are still reported
+                error = f"{type(exc).__name__}: {exc}"
+                bench.results.append({"suite": suite, "name": None, "params": {}, "failed": True, "error": error})
+                print(f"  {suite} FAILED {error}", file=sys.stderr)
+    finally:
+        if args.keep: print(f"Kept {workdir}", file=sys.stderr)
+        else: shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {"meta": {"revision": git_revision(), "python": platform.python_version(),
+                       "platform": platform.platform(), "timestamp": time.time(),
+                       "args": vars(args)},
+              "results": bench.results}
+    failed = [r for r in bench.results if r.get("failed")]
+    if args.output:
+        with open(args.output, "w") as outfile: json.dump(output, outfile, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
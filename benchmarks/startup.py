@@ -0,0 +1,94 @@
+""" Startup time check for the dkdep cli.
+
+Times `dkdep --help` and `dkdep versions describe` (each in a fresh interpreter, best of N runs, less
+the time a bare interpreter takes to start) and checks that none of the heavy dependencies that only
+some commands need are imported by them.  Exits with a non zero status if either command is over the
+budget or pulls in a heavy dependency so this can be used as a regression check (see `make test-startup`).
+
+    python benchmarks/startup.py [--runs N] [--budget-ms MS] [--json]
+"""
+import os, sys, json, time, argparse, subprocess, tempfile
+
+# Dependencies that must only be loaded by the commands that actually use them
+HEAVY_MODULES = ["fabric", "paramiko", "invoke", "cryptography", "boto3", "botocore", "ipdb"]
+DEFAULT_BUDGET_MS = int(os.environ.get("DKDEP_STARTUP_BUDGET_MS", "400"))
+
+SAMPLE_MANIFEST = """name: startup
+versions:
+- name: v1
+  versiontag: v1
+  created_at: 1.0
+  packages:
+  - name: pkg
+    repo_url: git@example.com:org/pkg
+    versiontag: pkg_1
+"""
+
+# Runs a dkdep command in process and reports which of the heavy modules it imported
+PROBE = """
+import sys, json
+from dkdeputils.main import app
+try: app(sys.argv[2:], prog_name="dkdep")
+except SystemExit: pass
+print(json.dumps(sorted(m for m in json.loads(sys.argv[1]) if m in sys.modules)))
+"""
+
+def best_time(cmd, runs, env):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, env=env)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def heavy_imports(args, env):
+    out = subprocess.run([sys.executable, "-c", PROBE, json.dumps(HEAVY_MODULES)] + args,
+                         check=True, capture_output=True, text=True, env=env).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def prepare(tmpdir):
+    """ Writes the sample manifest to tmpdir and returns the environment to run dkdep in and the
+    commands (name -> dkdep args) that are checked. """
+    rootdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    manifest = os.path.join(tmpdir, "manifest")
+    with open(manifest, "w") as outfile: outfile.write(SAMPLE_MANIFEST)
+    env = dict(os.environ, PYTHONPATH=rootdir, DepToolsManifestCache=os.path.join(tmpdir, "cache"))
+    commands = {
+        "help": ["--help"],
+        "describe": ["--manifest-path", manifest, "versions", "describe", "v1"],
+    }
+    return env, commands
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Checks the startup time of the dkdep cli")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=int, default=DEFAULT_BUDGET_MS, help="Allowed time over a bare interpreter start")
+    parser.add_argument("--json", action="store_true", help="Print results as json")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env, commands = prepare(tmpdir)
+        baseline = best_time([sys.executable, "-c", "pass"], args.runs, env)
+        results = {"baseline_ms": round(baseline * 1000, 1), "budget_ms": args.budget_ms, "commands": {}}
+        failed = False
+        for name, cmdargs in commands.items():
+            # warm up (and populate the manifest cache) before timing
+            heavy_imports(cmdargs, env)
+            elapsed = best_time([sys.executable, "-m", "dkdeputils.main"] + cmdargs, args.runs, env) - baseline
+            heavy = heavy_imports(cmdargs, env)
+            ok = elapsed * 1000 <= args.budget_ms and not heavy
+            failed = failed or not ok
+            results["commands"][name] = {"ms": round(elapsed * 1000, 1), "heavy_imports": heavy, "ok": ok}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"bare interpreter: {results['baseline_ms']}ms, budget: {args.budget_ms}ms over that")
+        for name, r in results["commands"].items():
+            heavy = f" (imports {', '.join(r['heavy_imports'])})" if r["heavy_imports"] else ""
+            print(f"  {name:10s} {r['ms']:8.1f}ms  {'ok' if r['ok'] else 'FAILED'}{heavy}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
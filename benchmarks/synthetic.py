@@ -0,0 +1,52 @@
+""" Generators for synthetic manifests and local git repos used by the benchmarks. """
+import os, subprocess
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@example.com",
+    "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@example.com",
+}
+
+def git(cwd, *args):
+    env = dict(os.environ, **GIT_ENV)
+    return subprocess.run(["git"] + list(args), cwd=cwd, env=env, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True).stdout.strip()
+
+def manifest_json(name="bench", versions=100, packages=10, repo_url="git@example.com:org/{name}", uncommitted=True):
+    """ A deployment with `versions` versions of `packages` packages each.  Like a real history most
+    packages keep their tag from one version to the next and every version changes a few of them. """
+    out = {"name": name, "versions": []}
+    tags = {f"pkg{p}": f"{name}_pkg{p}_0" for p in range(packages)}
+    for v in range(versions):
+        for p in range(v % packages, packages, max(1, packages // 3)):
+            tags[f"pkg{p}"] = f"{name}_pkg{p}_{v}"
+        version = {"name": f"v{v}", "versiontag": f"v{v}", "packages": [
+            {"name": pkg, "repo_url": repo_url.format(name=pkg), "versiontag": tag} for pkg,tag in tags.items()
+        ]}
+        if v < versions - 1 or not uncommitted:
+            version["created_at"] = 1700000000.0 + v
+        out["versions"].append(version)
+    return out
+
+def make_origin(path, commits=20, filesize=1024, branch="main"):
+    """ Creates a bare repo at path with `commits` commits (each rewriting a file of filesize bytes)
+    on branch and returns its file:// url. """
+    work = path + ".work"
+    os.makedirs(work)
+    git(work, "init", "-q", "-b", branch)
+    for c in range(commits):
+        commit(work, c, filesize)
+    git(os.path.dirname(path), "clone", "-q", "--bare", work, path)
+    return f"file://{path}"
+
+def commit(workdir, n, filesize=1024):
+    """ Adds a commit to the working repo at workdir. """
+    with open(os.path.join(workdir, f"file{n % 10}.txt"), "w") as outfile:
+        outfile.write((f"{n} " * filesize)[:filesize])
+    git(workdir, "add", "-A")
+    git(workdir, "commit", "-q", "-m", f"commit {n}")
+
+def push_commit(origin_path, n, filesize=1024):
+    """ Adds a commit on top of main in the bare repo at origin_path (via its .work clone). """
+    work = origin_path + ".work"
+    commit(work, n, filesize)
+    git(work, "push", "-q", origin_path, "HEAD:main")
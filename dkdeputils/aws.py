@@ -1,9 +1,8 @@
 
-import os
-from fabric import task, Connection, SerialGroup, ThreadingGroup
-from invoke import run as local
-from ipdb import set_trace
-import json, time
+import os, re
+import json, time, shlex, threading, datetime, copy
+from dkdeputils.parallel import DEFAULT_JOBS, run_parallel, report_failures
+from dkdeputils.profiling import local, span
 
 def aws_has_tag(res, key, value):
     for tag in res.get("Tags", []):
@@ -12,16 +11,325 @@ def aws_has_tag(res, key, value):
     return False
 
 def aws_tag_spec(restype, **tags):
-    tagstr = ",".join("{Key=" + key + ",Value=" + value + "}" for (key,value) in tags.items())
-    return f'ResourceType={restype},Tags=[{tagstr}]'
+    return {"ResourceType": restype,
+            "Tags": [{"Key": key, "Value": value} for (key,value) in tags.items()]}
+
+def aws_filters(**filters):
+    """ Server side filters for describe calls, eg aws_filters(**{"tag:Name": "x", "instance-state-name": ["running"]}) """
+    return [{"Name": name, "Values": values if isinstance(values, list) else [values]}
+            for (name,values) in filters.items()]
+
+def kebab_case(operation):
+    """ DescribeInstances -> describe-instances """
+    return re.sub(r"(?<!^)(?=[A-Z])", "-", operation).lower()
+
+def snake_case(operation):
+    """ DescribeInstances -> describe_instances """
+    return kebab_case(operation).replace("-", "_")
+
+# aws cli options whose RunInstances parameter is not just the option in CamelCase
+CLI_PARAM_NAMES = {"TagSpecification": "TagSpecifications", "BlockDeviceMapping": "BlockDeviceMappings"}
+# RunInstances parameters taking a list, given space separated to the aws cli
+CLI_LIST_PARAMS = ("SecurityGroupIds", "SecurityGroups")
+
+def cli_to_api_params(config):
+    """ Converts a creation config written for the aws cli run-instances command (as taken before
+    RunInstances was called directly), eg {"--image-id": "ami-1", "--security-group-ids": "sg-1 sg-2"},
+    to RunInstances parameters, eg {"ImageId": "ami-1", "SecurityGroupIds": ["sg-1", "sg-2"]}.
+    Keys already in api form are kept as is.  Options in the cli shorthand syntax (other than tag
+    specifications) cannot be converted and raise an error naming the parameter to use instead. """
+    params = {}
+    for key, value in config.items():
+        if not key.startswith("--"):
+            params[key] = value
+            continue
+        name = "".join(part.capitalize() for part in key[2:].split("-"))
+        name = CLI_PARAM_NAMES.get(name, name)
+        if name == "Count": continue    # one instance is launched per spec
+        if isinstance(value, str) and value.lstrip().startswith(("[", "{")):
+            value = json.loads(value)
+        if name == "TagSpecifications":
+            value = parse_tag_specs(value)
+        elif name in CLI_LIST_PARAMS and isinstance(value, str):
+            value = value.split()
+        elif isinstance(value, str) and "=" in value and name != "UserData":
+            raise Exception(f"Cannot convert the aws cli option {key} {value!r} in the creation config.  "
+                            f"Pass it as the RunInstances parameter {name} (eg a list/dict) instead.")
+        params[name] = value
+    return params
+
+def parse_tag_specs(value):
+    """ TagSpecifications from a spec (eg from aws_tag_spec), a list of them or the aws cli's shorthand
+    "ResourceType=instance,Tags=[{Key=Name,Value=x}]" (as aws_tag_spec used to return). """
+    if isinstance(value, dict): return [value]
+    if not isinstance(value, str): return list(value)
+    specs = [{"ResourceType": restype, "Tags": [{"Key": k, "Value": v} for k,v in re.findall(r"\{Key=([^,}]*),Value=([^}]*)\}", tags)]}
+             for restype, tags in re.findall(r"ResourceType=([\w-]+),Tags=\[([^\]]*)\]", value)]
+    if not specs:
+        raise Exception(f"Cannot parse the tag specifications {value!r}.  Pass TagSpecifications (see aws_tag_spec) instead.")
+    return specs
+
+def jsonify(obj):
+    """ Converts an sdk response to the same shapes the aws cli returns (eg datetimes as iso strings). """
+    if isinstance(obj, dict): return {k: jsonify(v) for k,v in obj.items()}
+    if isinstance(obj, (list, tuple)): return [jsonify(v) for v in obj]
+    if isinstance(obj, datetime.datetime): return obj.isoformat()
+    if isinstance(obj, bytes): return obj.decode()
+    return obj
+
+PROTOCOL_NAMES = {"6": "tcp", "17": "udp", "1": "icmp", "all": "-1"}
+
+class IngressRule:
+    """ Desired inbound access for a protocol on a set of ports from a set of cidrs.  ports can hold
+    single ports, (from, to) ranges or "from-to" strings and cidrs can be ipv4 or ipv6 ranges.
+    Protocol "-1" means all protocols and ports. """
+    def __init__(self, ports=(), protocol="tcp", cidrs=None):
+        self.protocol = PROTOCOL_NAMES.get(str(protocol).lower(), str(protocol).lower())
+        self.ports = [parse_port_range(p) for p in ports]
+        self.cidrs = cidrs or ["0.0.0.0/0"]
+
+    def atoms(self):
+        """ (protocol, from port, to port, cidr) for every port range and cidr in this rule. """
+        ranges = [(None, None)] if self.protocol == "-1" else self.ports
+        return [(self.protocol, fromport, toport, cidr) for (fromport, toport) in ranges for cidr in self.cidrs]
+
+def parse_port_range(port):
+    if isinstance(port, (tuple, list)): return int(port[0]), int(port[1])
+    if isinstance(port, str) and "-" in port:
+        fromport, toport = port.split("-", 1)
+        return int(fromport), int(toport)
+    return int(port), int(port)
+
+def permission_covered(permissions, atom):
+    """ Whether any of the IpPermissions (as returned by DescribeSecurityGroups) already allows atom. """
+    protocol, fromport, toport, cidr = atom
+    for perm in permissions:
+        permproto = PROTOCOL_NAMES.get(str(perm.get("IpProtocol")), str(perm.get("IpProtocol")))
+        if permproto != "-1":
+            if permproto != protocol: continue
+            if fromport is not None and not (perm.get("FromPort", -1) <= fromport and toport <= perm.get("ToPort", -1)):
+                continue
+        if ":" in cidr:
+            if any(r.get("CidrIpv6") == cidr for r in perm.get("Ipv6Ranges", [])): return True
+        elif any(r.get("CidrIp") == cidr for r in perm.get("IpRanges", [])): return True
+    return False
+
+def ip_permissions(atoms):
+    """ Groups (protocol, from, to, cidr) atoms into as few IpPermissions as possible. """
+    perms = {}
+    for protocol, fromport, toport, cidr in sorted(atoms, key=lambda a: (a[0], a[1] or -1, a[2] or -1, a[3])):
+        perm = perms.get((protocol, fromport, toport))
+        if perm is None:
+            perm = perms[(protocol, fromport, toport)] = {"IpProtocol": protocol}
+            if fromport is not None:
+                perm["FromPort"], perm["ToPort"] = fromport, toport
+        if ":" in cidr:
+            perm.setdefault("Ipv6Ranges", []).append({"CidrIpv6": cidr})
+        else:
+            perm.setdefault("IpRanges", []).append({"CidrIp": cidr})
+    return list(perms.values())
+
+class AWSError(Exception):
+    def __init__(self, service, operation, message):
+        super().__init__(f"{service}.{operation} failed: {message}")
+        self.service = service
+        self.operation = operation
+
+class CLIBackend:
+    """ Makes calls by running the aws cli, passing the request parameters via --cli-input-json. """
+    def __init__(self, region, profile):
+        self.region = region
+        self.profile = profile
+
+    def call(self, service, operation, **params):
+        cmdstr = f"aws --profile={self.profile} --region={self.region} --output=json {service} {kebab_case(operation)}"
+        if params: cmdstr += f" --cli-input-json {shlex.quote(json.dumps(params))}"
+        # When paging ourselves stop the cli from fetching (and buffering) all the remaining pages
+        if "MaxResults" in params: cmdstr += " --no-paginate"
+        res = local(cmdstr, hide=True, warn=True)
+        if res.failed:
+            raise AWSError(service, operation, res.stderr.strip())
+        out = res.stdout.strip()
+        return json.loads(out) if out else {}
+
+class Boto3Backend:
+    """ Makes calls in process with a boto3 session.  Clients (and their connection pools) are created
+    once per service and reused.  endpoint_url can point the clients at a local stub/mock endpoint. """
+    def __init__(self, region, profile, endpoint_url=None, session=None, max_pool_connections=20):
+        import boto3, botocore.config
+        self.session = session or boto3.Session(profile_name=profile, region_name=region)
+        self.endpoint_url = endpoint_url
+        self.config = botocore.config.Config(max_pool_connections=max_pool_connections)
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def client(self, service):
+        with self.lock:
+            if service not in self.clients:
+                self.clients[service] = self.session.client(service, endpoint_url=self.endpoint_url, config=self.config)
+            return self.clients[service]
+
+    def call(self, service, operation, **params):
+        import botocore.exceptions
+        try:
+            resp = getattr(self.client(service), snake_case(operation))(**params)
+        except botocore.exceptions.BotoCoreError as exc:
+            raise AWSError(service, operation, str(exc))
+        except botocore.exceptions.ClientError as exc:
+            raise AWSError(service, operation, str(exc))
+        resp.pop("ResponseMetadata", None)
+        return jsonify(resp)
+
+class StubBackend:
+    """ A backend for tests that returns canned responses instead of calling aws.  responses maps
+    (service, operation) to either a response dict or a function called with the request params.
+    All calls made are recorded in self.calls. """
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.calls = []
+
+    def call(self, service, operation, **params):
+        self.calls.append((service, operation, params))
+        resp = self.responses.get((service, operation), {})
+        if callable(resp): resp = resp(**params)
+        if isinstance(resp, Exception): raise resp
+        return json.loads(json.dumps(resp))
+
+# Operations with these prefixes only read state and their responses can be cached
+READ_ONLY_PREFIXES = ("Describe", "List", "Get")
+DEFAULT_CACHE_TTL = 30
+
+class DescribeCache:
+    """ Caches responses of read only calls for ttl seconds.  Any other (mutating) call on a
+    service drops all cached responses for that service.  Each invalidation bumps the service's
+    generation so a response read before (or during) a mutation is never cached after it. """
+    def __init__(self, ttl=DEFAULT_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def generation(self, service):
+        with self.lock:
+            return self.generations.get(service, 0)
+
+    def key(self, service, operation, params):
+        return (service, operation, json.dumps(params, sort_keys=True, default=str))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            return copy.deepcopy(entry[1])
+        return None
+
+    def put(self, key, value, generation=None):
+        """ Caches value unless the service has been invalidated since generation (if given). """
+        with self.lock:
+            if generation is not None and self.generations.get(key[0], 0) != generation: return
+            self.entries[key] = (time.monotonic(), copy.deepcopy(value))
+
+    def invalidate(self, service=None):
+        with self.lock:
+            services = [service] if service else set(self.generations) | set(k[0] for k in self.entries)
+            for s in services:
+                self.generations[s] = self.generations.get(s, 0) + 1
+            for key in list(self.entries):
+                if service is None or key[0] == service:
+                    del self.entries[key]
+
+def make_backend(backend, region, profile, endpoint_url=None):
+    """ Creates a backend by name.  "auto" uses boto3 if it is installed and the aws cli otherwise. """
+    if backend == "auto":
+        try:
+            import boto3
+            backend = "boto3"
+        except ImportError:
+            backend = "cli"
+    if backend == "boto3": return Boto3Backend(region, profile, endpoint_url)
+    if backend == "cli": return CLIBackend(region, profile)
+    raise ValueError(f"Unknown aws backend: {backend}")
+
+# Describe operations that accept MaxResults/NextToken (when not given explicit ids)
+PAGINATED_OPERATIONS = {"DescribeInstances", "DescribeSecurityGroups", "DescribeImages", "DescribeVolumes",
+                        "DescribeSnapshots", "DescribeSubnets", "DescribeVpcs", "DescribeNetworkInterfaces"}
+DEFAULT_PAGE_SIZE = 100
+
+LIVE_INSTANCE_STATES = ["pending", "running", "stopping", "stopped", "shutting-down"]
+DEFAULT_INSTANCE_TIMEOUT = 600
+
+def instance_state(inst):
+    return inst.get("State", {}).get("Name", "").lower()
 
 class AWSClient:
-    def __init__(self, ctx, region="us-west-2", profile="dagknows"):
+    def __init__(self, ctx, region="us-west-2", profile="dagknows", backend="auto", endpoint_url=None, cache_ttl=DEFAULT_CACHE_TTL):
+        """ backend can be "boto3", "cli", "auto" or a backend instance (eg a StubBackend).
+        Responses of read only calls are cached for cache_ttl seconds (0 disables caching). """
         self.ctx = ctx
         self.region = region
         self.profile = profile
+        if isinstance(backend, str):
+            backend = make_backend(backend, region, profile, endpoint_url)
+        self.backend = backend
+        self.cache = DescribeCache(cache_ttl) if cache_ttl else None
+        self.images = {}
+
+    def call(self, service, operation, **params):
+        """ Calls an aws api operation (eg "ec2", "DescribeInstances") with api shaped parameters and
+        returns the response in the same shape as the aws cli's json output. """
+        if not self.cache:
+            return self.backend_call(service, operation, params)
+        if not operation.startswith(READ_ONLY_PREFIXES):
+            # Invalidated again once the call returns so that reads made by other threads while it
+            # was in flight (which may have seen the state before it) do not outlive it
+            self.cache.invalidate(service)
+            try:
+                return self.backend_call(service, operation, params)
+            finally:
+                self.cache.invalidate(service)
+        key = self.cache.key(service, operation, params)
+        resp = self.cache.get(key)
+        if resp is None:
+            generation = self.cache.generation(service)
+            resp = self.backend_call(service, operation, params)
+            self.cache.put(key, resp, generation)
+        return resp
+
+    def backend_call(self, service, operation, params):
+        with span("aws", f"{service} {operation}", host=self.region) as s:
+            resp = self.backend.call(service, operation, **params)
+            if s: s.output_bytes = len(json.dumps(resp, default=str))
+            return resp
+
+    def invalidate(self, service=None):
+        """ Drops cached responses (for a service or for all of them). """
+        if self.cache: self.cache.invalidate(service)
+
+    def paginate(self, service, operation, page_size=DEFAULT_PAGE_SIZE, **params):
+        """ Yields the response pages of a describe call one at a time, only fetching the next page when
+        the previous one has been consumed.  Operations that do not page return a single page. """
+        if page_size and operation in PAGINATED_OPERATIONS and not any(k.endswith("Ids") for k in params):
+            params["MaxResults"] = page_size
+        while True:
+            page = self.call(service, operation, **params)
+            yield page
+            token = page.get("NextToken")
+            if not token: return
+            params = dict(params, NextToken=token)
+
+    def iterate(self, service, operation, key, page_size=DEFAULT_PAGE_SIZE, **params):
+        """ Yields the items under key (eg "SecurityGroups") across all the pages of a describe call. """
+        for page in self.paginate(service, operation, page_size, **params):
+            yield from page.get(key, [])
+
+    def iter_instances(self, filters=None, page_size=DEFAULT_PAGE_SIZE):
+        """ Yields instances (across all reservations) a page at a time. """
+        params = {"Filters": filters} if filters else {}
+        for reservation in self.iterate("ec2", "DescribeInstances", "Reservations", page_size, **params):
+            yield from reservation.get("Instances", [])
 
     def run(self, cmd, *subcmds, **options):
+        """ Runs a raw aws cli command (always through the cli regardless of the backend). """
         s2 = " ".join(subcmds)
         argstr = " ".join([f"{k} '{v}'" for k,v in options.items()])
         cmdstr = f"aws --profile={self.profile} --region={self.region} {cmd} {s2} {argstr}"
@@ -37,100 +345,210 @@ class AWSClient:
         return res
 
     def ensure_elastic_ip(self, ipname):
-        pairs = self.run("ec2", "describe-addresses").get("Addresses", [])
+        pairs = self.call("ec2", "DescribeAddresses", Filters=aws_filters(**{"tag:Name": ipname})).get("Addresses", [])
         pairs = [p for p in pairs if aws_has_tag(p, "Name", ipname)]
         if pairs: return pairs[0], False
-        pair = self.run("ec2", "allocate-address", **{
-            "--tag-specification": aws_tag_spec("address", **{ "Name": ipname }),
-        })
+        pair = self.call("ec2", "AllocateAddress",
+                         TagSpecifications=[aws_tag_spec("elastic-ip", **{ "Name": ipname })])
         return pair, True
 
     def ensure_key_pair(self, name, keyfile):
         exists= os.path.isfile(keyfile)
         if exists:
-            pairs = self.run("ec2", "describe-key-pairs")["KeyPairs"]
+            pairs = self.call("ec2", "DescribeKeyPairs", Filters=aws_filters(**{"key-name": name}))["KeyPairs"]
             thepair = [p for p in pairs if p.get("KeyName") == name]
             exists = len(thepair) > 0
 
         if not exists:
             # delete first in case
-            self.run("ec2", "delete-key-pair", **{ "--key-name":  name, })
-            res = self.run("ec2", "create-key-pair", **{
-                "--key-name": name,
-            })
+            try: self.call("ec2", "DeleteKeyPair", KeyName=name)
+            except AWSError: pass
+            res = self.call("ec2", "CreateKeyPair", KeyName=name)
             pemdata = res["KeyMaterial"]
             with open(keyfile, "w") as kf:
                 kf.write(pemdata)
-            local(f"chmod 400 {keyfile}")
+            os.chmod(keyfile, 0o400)
         return True
 
-    def ensure_sec_group_connectivity(self, sec_group_id, newports=None):
+    def ensure_sec_group_connectivity(self, sec_group_id, newports=None, ipv6=False):
         """ Ensures we have connectivity to this sec group on the right protocols """
         newports = newports or [22, 80, 443]
-        all_sgs =  self.run("ec2", "describe-security-groups")["SecurityGroups"]
-        sgs = [sg for sg in all_sgs if sg["GroupId"] == sec_group_id]
-        if not sgs:
+        all_sgs = self.iterate("ec2", "DescribeSecurityGroups", "SecurityGroups", Filters=aws_filters(**{"group-id": sec_group_id}))
+        sg = next((sg for sg in all_sgs if sg["GroupId"] == sec_group_id), None)
+        if not sg:
             raise Exception(f"You may have deleted the security group {sec_group_id}")
-        sg = sgs[0]
         if not aws_has_tag(sg, "IngressInited", "True"):
             # Setup inbound rules too
             print("setting inbound access for https and ssh")
-            existing_ports = set(ipperm["FromPort"] for ipperm in sg.get("IpPermissions", []) if "FromPort" in ipperm)
-            for port in newports:
-                if port not in existing_ports:
-                    print("Enabling inbound tcp port: ", port)
-                    self.run("ec2", "authorize-security-group-ingress", **{
-                        "--group-id": sg["GroupId"],
-                        "--protocol": "tcp",
-                        "--port": port,
-                        "--cidr": "0.0.0.0/0",
-                    })
-
-                    if False and port != 22:
-                        # Also enable ipv6
-                        ec2("authorize-security-group-ingress", **{
-                            "--group-id": sg["GroupId"],
-                            "--protocol": "tcp",
-                            "--port": port,
-                            "--cidr": "::/0",
-                        })
-
-
-    def ensure_instance(self, filterfunc, creation_config):
-        """ Ensures we have an instance that matches a given condition and if not creates it. """
-        checker = lambda x: filterfunc(x) and x.get("State", {}).get("Name", "").lower() != "terminated"
-        inst = self.find_instance(checker)
-        newcreated = inst is None
-        if not inst:
-            imageid = creation_config["--image-id"]
-            imageinfo = self.run("ec2", "describe-images", **{
-                "--image-id": imageid
-            })["Images"]
-            devname = imageinfo[0]["BlockDeviceMappings"][0]["DeviceName"]
-            volsize = creation_config.get("VolumeSize", 100)
-            creation_config.update(**{
-                "--block-device-mapping": f"DeviceName={devname},Ebs={{VolumeSize={volsize}}}"
-            })
-            result = self.run("ec2", "run-instances", **creation_config)
-            inst = result["Instances"][0]
-            inst_state = inst.get("State", {}).get("Name", "")
-            while inst_state.lower() != "running":
-                print("Waiting for instance to get to running state...")
-                time.sleep(3)
-                inst = self.find_instance(checker)
-                inst_state = inst.get("State", {}).get("Name", "")
-
-        inst_state = inst.get("State", {}).get("Name", "")
-        if inst_state.lower() != "running":
-            print("Instance state is not 'running'.  Wait for a while or terminate it")
-        return inst, newcreated
-
-    def find_instance(self, matchfunc):
-        """ Finds the first instance that matches the given criteria. """
-        instances = self.run("ec2", "describe-instances")
-        reservations = instances["Reservations"]
-        for res in reservations:
-            for inst in res["Instances"]:
-                if matchfunc(inst):
-                    return inst
-        return None
+            rules = [IngressRule(newports)]
+            if ipv6:
+                # Also enable ipv6 (but not for ssh)
+                rules.append(IngressRule([p for p in newports if p != 22], cidrs=["::/0"]))
+            self.reconcile_ingress({sec_group_id: rules}, groups=[sg])
+
+    def reconcile_ingress(self, rules_by_group, jobs=DEFAULT_JOBS, groups=None):
+        """ Ensures each security group (id) in rules_by_group allows all of its IngressRules.
+        The groups are described with one call, only the permissions that are not already covered
+        are computed and each group's missing permissions are authorized with a single call, for
+        upto `jobs` groups concurrently.  groups can pass in already described security groups.
+        Returns a dict of group id -> the IpPermissions that were added. """
+        groups = {sg["GroupId"]: sg for sg in (groups or [])}
+        missing = [gid for gid in rules_by_group if gid not in groups]
+        if missing:
+            for sg in self.iterate("ec2", "DescribeSecurityGroups", "SecurityGroups", Filters=aws_filters(**{"group-id": missing})):
+                groups[sg["GroupId"]] = sg
+        for gid in rules_by_group:
+            if gid not in groups:
+                raise Exception(f"You may have deleted the security group {gid}")
+
+        def reconcile(gid, log):
+            existing = groups[gid].get("IpPermissions", [])
+            wanted = set(atom for rule in rules_by_group[gid] for atom in rule.atoms())
+            perms = ip_permissions(atom for atom in wanted if not permission_covered(existing, atom))
+            if perms:
+                log(f"Authorizing {len(perms)} ingress permission(s) on {gid}: ", json.dumps(perms))
+                self.call("ec2", "AuthorizeSecurityGroupIngress", GroupId=gid, IpPermissions=perms)
+            return perms
+        results = run_parallel(reconcile, list(rules_by_group), jobs)
+        failed = report_failures("Ingress reconciliation", results)
+        if failed: raise failed[0].error
+        return {r.key: r.value for r in results}
+
+    def ensure_instance(self, filterfunc, creation_config, filters=None, timeout=DEFAULT_INSTANCE_TIMEOUT):
+        """ Ensures we have an instance that matches a given condition and if not creates it.
+        creation_config holds the RunInstances parameters (eg ImageId, InstanceType, KeyName) and
+        optionally a VolumeSize (in GB) for the root volume.  filters are optional server side
+        filters (see aws_filters) that narrow down the instances filterfunc has to look at. """
+        return self.ensure_instances([(filterfunc, creation_config, filters)], timeout)[0]
+
+    def ensure_instances(self, specs, timeout=DEFAULT_INSTANCE_TIMEOUT):
+        """ Ensures there is an instance for each of the (filterfunc, creation_config[, filters]) specs
+        (see ensure_instance), creating the missing ones and waiting till all of them are running.
+        Each existing instance satisfies at most one spec.  Missing instances whose creation configs
+        only differ in their instance tags are launched with a single RunInstances call.
+        Returns a list of (instance, newcreated) in the same order as specs. """
+        specs = [tuple(spec) + (None,) * (3 - len(spec)) for spec in specs]
+        found = self.find_instances_for_specs(specs)
+        results = [(inst, False) if inst else None for inst in found]
+
+        # Group the missing ones by everything but their instance tags
+        groups = {}
+        for i, (filterfunc, config, filters) in enumerate(specs):
+            if found[i]: continue
+            params, tags = self.launch_params(config)
+            groups.setdefault(json.dumps(params, sort_keys=True), (params, []))[1].append((i, tags))
+        for params, members in groups.values():
+            launched = self.launch_instances(params, [tags for i,tags in members])
+            for (i, tags), inst in zip(members, launched):
+                results[i] = (inst, True)
+
+        pending = [inst["InstanceId"] for inst,_ in results if instance_state(inst) == "pending"]
+        ready = self.wait_until_running(pending, timeout) if pending else {}
+        results = [(ready.get(inst["InstanceId"], inst), newcreated) for inst,newcreated in results]
+        for inst,_ in results:
+            if instance_state(inst) != "running":
+                print(f"Instance {inst['InstanceId']} state is not 'running'.  Wait for a while or terminate it")
+        return results
+
+    def find_instances_for_specs(self, specs):
+        """ Finds an existing (non terminated) instance for each spec with one streaming scan per
+        distinct set of filters, stopping as soon as every spec has a match. """
+        found = [None] * len(specs)
+        taken = set()
+        byfilters = {}
+        for i, spec in enumerate(specs):
+            byfilters.setdefault(json.dumps(spec[2] or [], sort_keys=True), []).append(i)
+        for indexes in byfilters.values():
+            filters = (specs[indexes[0]][2] or []) + aws_filters(**{"instance-state-name": LIVE_INSTANCE_STATES})
+            for inst in self.iter_instances(filters):
+                if inst["InstanceId"] in taken: continue
+                for i in indexes:
+                    if specs[i][0](inst):
+                        found[i] = inst
+                        taken.add(inst["InstanceId"])
+                        indexes = [j for j in indexes if j != i]
+                        break
+                if not indexes: break
+        return found
+
+    def image_info(self, imageid):
+        """ Details of an image.  These never change so they are cached for the life of the client. """
+        if imageid not in self.images:
+            self.images[imageid] = self.call("ec2", "DescribeImages", ImageIds=[imageid])["Images"][0]
+        return self.images[imageid]
+
+    def launch_params(self, creation_config):
+        """ Splits a creation config into RunInstances params (without counts) and the instance tags. """
+        params = cli_to_api_params(creation_config)
+        params.pop("MinCount", None)
+        params.pop("MaxCount", None)
+        volsize = params.pop("VolumeSize", 100)
+        if "BlockDeviceMappings" not in params:
+            if not params.get("ImageId"):
+                raise Exception(f"The creation config has no ImageId (it takes RunInstances parameters, eg ImageId, InstanceType, KeyName): {creation_config}")
+            devname = self.image_info(params["ImageId"])["BlockDeviceMappings"][0]["DeviceName"]
+            params["BlockDeviceMappings"] = [{"DeviceName": devname, "Ebs": {"VolumeSize": volsize}}]
+        tagspecs = params.pop("TagSpecifications", [])
+        tags = [t for spec in tagspecs if spec["ResourceType"] == "instance" for t in spec["Tags"]]
+        others = [spec for spec in tagspecs if spec["ResourceType"] != "instance"]
+        if others: params["TagSpecifications"] = others
+        return params, tags
+
+    def launch_instances(self, params, tags):
+        """ Launches len(tags) instances with one RunInstances call where tags[i] are the tags of the
+        i'th instance.  If the tags are not all the same they are applied after the launch. """
+        count = len(tags)
+        params = dict(params, MinCount=count, MaxCount=count)
+        sametags = all(t == tags[0] for t in tags)
+        if sametags and tags[0]:
+            params["TagSpecifications"] = params.get("TagSpecifications", []) + [{"ResourceType": "instance", "Tags": tags[0]}]
+        print(f"Launching {count} instance(s) of {params.get('InstanceType', '')} from {params.get('ImageId', '')}")
+        instances = self.call("ec2", "RunInstances", **params)["Instances"]
+        if not sametags:
+            for inst, insttags in zip(instances, tags):
+                if insttags:
+                    self.call("ec2", "CreateTags", Resources=[inst["InstanceId"]], Tags=insttags)
+                    inst["Tags"] = insttags
+        return instances
+
+    def wait_until_running(self, instance_ids, timeout=DEFAULT_INSTANCE_TIMEOUT, delay=1, max_delay=15):
+        """ Waits till all the given instances are running, polling them together with exponential
+        backoff.  Returns a dict of instance id -> instance.  Raises TimeoutError if they are not all
+        running within timeout seconds. """
+        deadline = time.monotonic() + timeout
+        pending = set(instance_ids)
+        ready = {}
+        while pending:
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Timed out waiting for instances to be running: {', '.join(sorted(pending))}")
+            print(f"Waiting for {len(pending)} instance(s) to get to running state...")
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+            self.invalidate("ec2")
+            try:
+                reservations = list(self.iterate("ec2", "DescribeInstances", "Reservations", InstanceIds=sorted(pending)))
+            except AWSError as exc:
+                # Newly launched instances can take a moment to become visible
+                print("Could not describe instances yet: ", exc)
+                continue
+            for res in reservations:
+                for inst in res.get("Instances", []):
+                    state = instance_state(inst)
+                    if state == "running":
+                        ready[inst["InstanceId"]] = inst
+                        pending.discard(inst["InstanceId"])
+                    elif state in ("shutting-down", "terminated", "stopping", "stopped"):
+                        raise Exception(f"Instance {inst['InstanceId']} is {state} while waiting for it to run")
+        return ready
+
+    def find_instance(self, matchfunc, filters=None):
+        """ Finds the first instance that matches the given criteria.  filters are optional server
+        side filters (see aws_filters) applied before matchfunc.  Pages are only fetched until a
+        match is found. """
+        return next(self.find_instances(matchfunc, filters), None)
+
+    def find_instances(self, matchfunc, filters=None):
+        """ Yields all instances that match the given criteria, a page at a time. """
+        for inst in self.iter_instances(filters):
+            if matchfunc(inst):
+                yield inst
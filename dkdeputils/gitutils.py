@@ -0,0 +1,71 @@
+""" Cheap git plumbing helpers that work on local checkouts without buffering diffs or touching the network. """
+import shlex
+from dkdeputils.profiling import local
+
+def git(repopath, *args, warn=False):
+    """ Runs a git command in repopath with its output captured (not echoed). """
+    return local(f"cd {repopath} && git " + " ".join(str(a) for a in args), hide=True, warn=warn)
+
+def rev_parse(repopath, *revs):
+    """ Resolves revs to object ids with one call.  Returns None if any of them cannot be resolved. """
+    res = git(repopath, "rev-parse", *revs, warn=True)
+    if res.failed: return None
+    ids = res.stdout.split()
+    return ids if len(ids) == len(revs) else None
+
+def head_sha(repopath):
+    """ The commit checked out in repopath (or "" if there is none). """
+    ids = rev_parse(repopath, "HEAD")
+    return ids[0] if ids else ""
+
+def has_commit(repopath, sha):
+    """ Returns True if the commit is already present in repopath's object store. """
+    return git(repopath, "cat-file", "-e", f"{sha}^{{commit}}", warn=True).ok
+
+def is_shallow(repopath):
+    return git(repopath, "rev-parse", "--is-shallow-repository", warn=True).stdout.strip() == "true"
+
+def resolve_commit(repopath, ref):
+    """ The commit ref resolves to locally - preferring a tag, then origin's branch, then anything
+    else git resolves it to - or "" if it cannot be resolved without fetching. """
+    candidates = [f"refs/tags/{ref}^{{commit}}", f"refs/remotes/origin/{ref}^{{commit}}", f"{ref}^{{commit}}"]
+    cmd = " || ".join(f"git rev-parse -q --verify {shlex.quote(c)}" for c in candidates)
+    res = local(f"cd {repopath} && ({cmd})", hide=True, warn=True)
+    return res.stdout.strip() if res.ok else ""
+
+def worktree_status(repopath):
+    """ HEAD's commit, the checked out branch (None if detached) and the number of changed (including
+    untracked) files of the working tree, from one `git status`.  Without optional locks git does not
+    refresh (and rewrite) the index so this never writes to the repo or contends for index.lock. """
+    res = git(repopath, "--no-optional-locks", "status", "--porcelain=v2", "--branch")
+    head, branch, changed = "", None, 0
+    for line in res.stdout.splitlines():
+        if line.startswith("# branch.oid "):
+            head = line.split()[2]
+            if head == "(initial)": head = ""
+        elif line.startswith("# branch.head "):
+            branch = line.split(" ", 2)[2]
+            if branch == "(detached)": branch = None
+        elif not line.startswith("#"):
+            changed += 1
+    return head, branch, changed
+
+def ahead_behind(repopath, base, head="HEAD"):
+    """ Returns (commits in head not in base, commits in base not in head). """
+    res = git(repopath, "rev-list", "--left-right", "--count", f"{base}...{head}")
+    behind, ahead = res.stdout.split()
+    return int(ahead), int(behind)
+
+def create_tag(repopath, tag, message=None):
+    """ Creates an annotated tag at HEAD. """
+    return git(repopath, "tag", "-a", tag, "-m", message or tag)
+
+def push_tag(repopath, tag, remote="origin"):
+    """ Pushes just the given tag (and not every local tag) to remote. """
+    return git(repopath, "push", remote, f"refs/tags/{tag}")
+
+def delete_tag(repopath, tag, remote=None):
+    """ Deletes a tag locally and if remote is given from the remote too. """
+    if remote:
+        git(repopath, "push", remote, f":refs/tags/{tag}")
+    return git(repopath, "tag", "-d", tag)
@@ -0,0 +1,79 @@
+""" Facts about hosts (installed packages, sysctl values, groups) gathered with one probe per host
+and cached locally for a while so that setup steps can be skipped on hosts that do not need them. """
+import os, json, time, shlex, hashlib
+from dkdeputils.profiling import remote
+
+DEFAULT_FACTS_CACHE = os.path.expanduser("~/.cache/dkdep/hostfacts")
+DEFAULT_FACTS_TTL = 600
+
+class FactProbe:
+    """ The set of facts to gather from a host. """
+    def __init__(self, packages=(), sysctls=(), groups=(), users=()):
+        self.packages = list(packages)
+        self.sysctls = list(sysctls)
+        self.groups = list(groups)
+        self.users = list(users)
+
+    @property
+    def key(self):
+        spec = json.dumps([self.packages, self.sysctls, self.groups, self.users])
+        return hashlib.sha1(spec.encode()).hexdigest()[:12]
+
+    def script(self):
+        """ A shell script that prints one "<kind>:<name>=<value>" line per fact. """
+        lines = []
+        for p in map(shlex.quote, self.packages):
+            lines.append(f"""if dpkg-query -W -f='${{Status}}' {p} 2>/dev/null | grep -q 'install ok installed'; then echo "pkg:"{p}"=1"; else echo "pkg:"{p}"=0"; fi""")
+        for k in map(shlex.quote, self.sysctls):
+            lines.append(f"""echo "sysctl:"{k}"=$(sysctl -n {k} 2>/dev/null)\"""")
+        for g in map(shlex.quote, self.groups):
+            lines.append(f"""if getent group {g} > /dev/null; then echo "group:"{g}"=1"; else echo "group:"{g}"=0"; fi""")
+        for u in map(shlex.quote, self.users):
+            lines.append(f"""echo "usergroups:"{u}"=$(id -nG {u} 2>/dev/null)\"""")
+        return "\n".join(lines)
+
+    def parse(self, output):
+        facts = {"packages": {}, "sysctls": {}, "groups": {}, "usergroups": {}}
+        for line in output.splitlines():
+            if ":" not in line or "=" not in line: continue
+            kind, rest = line.split(":", 1)
+            name, value = rest.split("=", 1)
+            if kind == "pkg": facts["packages"][name] = value == "1"
+            elif kind == "sysctl": facts["sysctls"][name] = value.strip()
+            elif kind == "group": facts["groups"][name] = value == "1"
+            elif kind == "usergroups": facts["usergroups"][name] = value.split()
+        return facts
+
+class FactCache:
+    """ Caches the facts gathered by a probe per host for ttl seconds. """
+    def __init__(self, root=DEFAULT_FACTS_CACHE, ttl=DEFAULT_FACTS_TTL):
+        self.root = root
+        self.ttl = ttl
+
+    def path(self, host, probe):
+        return os.path.join(self.root, f"{host}-{probe.key}.json")
+
+    def get(self, conn, probe, log=print):
+        """ Returns the facts for a host (a fabric Connection) probing it only if our cached ones are stale. """
+        path = self.path(conn.host, probe)
+        try:
+            with open(path) as infile:
+                cached = json.load(infile)
+            if time.time() - cached["gathered_at"] < self.ttl:
+                return cached["facts"]
+        except (OSError, ValueError, KeyError):
+            pass
+        log(f"Gathering facts from {conn.host}")
+        res = remote(conn, probe.script(), hide=True)
+        facts = probe.parse(res.stdout)
+        os.makedirs(self.root, exist_ok=True)
+        tmppath = f"{path}.{os.getpid()}.tmp"
+        with open(tmppath, "w") as outfile:
+            json.dump({"gathered_at": time.time(), "facts": facts}, outfile)
+        os.replace(tmppath, path)
+        return facts
+
+    def invalidate(self, host, probe):
+        """ Drops the cached facts for a host (eg after changing it). """
+        try: os.remove(self.path(host, probe))
+        except OSError: pass
@@ -0,0 +1,61 @@
+""" A binary cache of parsed manifests so commands do not have to reparse the yaml each time it is run.
+Cache entries are keyed by the manifest's absolute path and are only used when the manifest's mtime,
+size and content hash all match what was recorded. """
+import os, pickle, hashlib
+
+DEFAULT_MANIFEST_CACHE = os.path.expanduser("~/.cache/dkdep/manifests")
+CACHE_FORMAT = 1
+
+def cache_path(cachedir, path):
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(cachedir, f"{digest}.pickle")
+
+def lock_path(cachedir, path):
+    """ The file that (advisory) locks the manifest at path - in the cache dir so no lock files are
+    left next to manifests, or next to the manifest if there is no cache dir. """
+    if not cachedir: return path + ".lock"
+    os.makedirs(cachedir, exist_ok=True)
+    return os.path.join(cachedir, os.path.basename(cache_path(cachedir, path))[:-len(".pickle")] + ".lock")
+
+def file_key(path, data):
+    st = os.stat(path)
+    return {"format": CACHE_FORMAT,
+            "path": os.path.abspath(path),
+            "mtime": st.st_mtime_ns,
+            "size": st.st_size,
+            "sha1": hashlib.sha1(data).hexdigest()}
+
+def load(cachedir, path, parser):
+    """ Returns the parsed contents of the file at path, calling parser(data) only if
+    there is no valid cache entry for it (and then caching the result). """
+    with open(path, "rb") as infile:
+        data = infile.read()
+    key = file_key(path, data)
+    if cachedir:
+        try:
+            with open(cache_path(cachedir, path), "rb") as cachefile:
+                cached = pickle.load(cachefile)
+            if cached["key"] == key:
+                return cached["contents"]
+        except Exception:
+            pass
+    contents = parser(data)
+    store(cachedir, path, contents, key)
+    return contents
+
+def store(cachedir, path, contents, key=None):
+    """ Records contents as the parsed form of the file at path (as it is on disk right now). """
+    if not cachedir: return
+    try:
+        if not key:
+            with open(path, "rb") as infile:
+                key = file_key(path, infile.read())
+        os.makedirs(cachedir, exist_ok=True)
+        outpath = cache_path(cachedir, path)
+        tmppath = f"{outpath}.{os.getpid()}.tmp"
+        with open(tmppath, "wb") as cachefile:
+            pickle.dump({"key": key, "contents": contents}, cachefile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, outpath)
+    except OSError as exc:
+        # The cache is only an optimization so never fail because of it
+        print(f"Could not update manifest cache for {path}: {exc}")
@@ -0,0 +1,102 @@
+""" A persistent cache of bare repo mirrors that checkouts are cloned and fetched from so that each
+repo's history is only ever downloaded once (and then incrementally) per machine. """
+import os, shutil, hashlib, fcntl, threading
+from contextlib import contextmanager
+from dkdeputils.profiling import local
+
+DEFAULT_MIRROR_CACHE = os.path.expanduser("~/.cache/dkdep/mirrors")
+DEFAULT_MIRROR_CACHE_SIZE_MB = 5 * 1024
+LAST_USED_MARKER = "dkdep-last-used"
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try: total += os.lstat(os.path.join(root, f)).st_size
+            except OSError: pass
+    return total
+
+class MirrorCache:
+    """ One bare mirror per repo_url under root.  Mirrors are fetched at most once per MirrorCache
+    instance (ie per command) and the least recently used ones are evicted once the cache grows
+    beyond max_size_mb. """
+    def __init__(self, root=DEFAULT_MIRROR_CACHE, max_size_mb=DEFAULT_MIRROR_CACHE_SIZE_MB):
+        self.root = root
+        self.max_size_mb = max_size_mb
+        self.updated = set()
+        self.lock = threading.Lock()
+
+    def mirror_path(self, repo_url):
+        digest = hashlib.sha1(repo_url.encode()).hexdigest()[:16]
+        basename = os.path.basename(repo_url.rstrip("/"))
+        if basename.endswith(".git"): basename = basename[:-4]
+        return os.path.join(self.root, f"{basename}-{digest}.git")
+
+    def ensure(self, repo_url, log=print):
+        """ Creates or incrementally updates the mirror for repo_url and returns its path.  Use `using`
+        instead if the mirror is read afterwards. """
+        with self.using(repo_url, log) as path:
+            return path
+
+    @contextmanager
+    def using(self, repo_url, log=print):
+        """ Creates or incrementally updates the mirror for repo_url and yields its path, holding a
+        shared lock on it for the block so that other dkdep processes can neither update nor evict
+        it while it is being cloned, fetched or archived from. """
+        path = self.mirror_path(repo_url)
+        os.makedirs(self.root, exist_ok=True)
+        with open(path + ".lock", "a") as lockfile:
+            while True:
+                with self.lock: fresh = path in self.updated
+                if not fresh or not os.path.isdir(path):
+                    fcntl.flock(lockfile, fcntl.LOCK_EX)
+                    self.update(path, repo_url, log)
+                # Converting the lock is not atomic so check it was not evicted in between
+                fcntl.flock(lockfile, fcntl.LOCK_SH)
+                if os.path.isdir(path): break
+            with open(os.path.join(path, LAST_USED_MARKER), "w"): pass
+            try:
+                yield path
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def update(self, path, repo_url, log=print):
+        """ Creates the mirror at path or fetches into it (once per instance).  Callers must hold its lock exclusively. """
+        with self.lock:
+            fresh = path in self.updated
+            self.updated.add(path)
+        if not os.path.isdir(path):
+            log(f"Creating mirror {repo_url} -> {path}")
+            tmppath = f"{path}.tmp{os.getpid()}"
+            shutil.rmtree(tmppath, ignore_errors=True)
+            local(f"git clone --bare {repo_url} {tmppath}", hide=True)
+            local(f"git --git-dir={tmppath} config remote.origin.fetch '+refs/heads/*:refs/heads/*'", hide=True)
+            local(f"git --git-dir={tmppath} config --add remote.origin.fetch '+refs/tags/*:refs/tags/*'", hide=True)
+            os.rename(tmppath, path)
+        elif not fresh:
+            log(f"Updating mirror {path}")
+            local(f"git --git-dir={path} fetch --prune origin", hide=True)
+
+    def last_used(self, path):
+        try: return os.path.getmtime(os.path.join(path, LAST_USED_MARKER))
+        except OSError: return 0
+
+    def evict(self, log=print):
+        """ Removes the least recently used mirrors (except ones used by this instance) until the
+        cache fits in max_size_mb.  Mirrors locked by other processes (see using) are skipped. """
+        if not os.path.isdir(self.root): return []
+        mirrors = [os.path.join(self.root, d) for d in os.listdir(self.root) if d.endswith(".git")]
+        sizes = {m: dir_size(m) for m in mirrors}
+        total = sum(sizes.values())
+        evicted = []
+        for m in sorted(mirrors, key=self.last_used):
+            if total <= self.max_size_mb * 1024 * 1024: break
+            if m in self.updated: continue
+            with open(m + ".lock", "a") as lockfile:
+                try: fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError: continue    # in use by another process
+                log(f"Evicting mirror {m}")
+                shutil.rmtree(m, ignore_errors=True)
+            total -= sizes[m]
+            evicted.append(m)
+        return evicted
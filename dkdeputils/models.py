@@ -1,30 +1,116 @@
-from invoke import run as local
 from typing import List, Dict
-import os, sys, yaml, json, time
+from dkdeputils.parallel import DEFAULT_JOBS, run_parallel, report_failures
+from dkdeputils import manifestcache
+from dkdeputils.manifestcache import DEFAULT_MANIFEST_CACHE
+import os, sys, json, time, stat, fcntl, tempfile, functools, weakref
+from contextlib import contextmanager
 
 DEFAULT_MAIN = "main"
 DEFAULT_REPO_FOLDER="./repos"
 
+# yaml is imported lazily as a valid manifest cache means it is often not needed at all.
+# The libyaml based loader/dumper are used when available - they are several times faster.
 def yamldump(obj):
-    return yaml.dump(obj, sort_keys=False)
+    import yaml
+    return yaml.dump(obj, Dumper=getattr(yaml, "CDumper", yaml.Dumper), sort_keys=False)
+
+def yamlload(data):
+    import yaml
+    return yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+def batched(method):
+    """ Runs a Manifest mutation in a batch so it sees the latest manifest on disk and is written out once. """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.batch():
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class Manifest:
-    def __init__(self, path):
+    def __init__(self, path, cachedir=DEFAULT_MANIFEST_CACHE):
         self.path = path
+        self.cachedir = cachedir
         self.deployment = Deployment("")
+        self._batch_depth = 0
+        self._dirty = False
         self.load()
 
     def load(self, path=None):
         path = path or self.path
-        contents = yaml.safe_load(open(path).read()) or {}
+        contents = manifestcache.load(self.cachedir, path, yamlload) or {}
+        self.deployment = Deployment("")
         if contents:
             self.deployment.from_json(contents)
         return self
 
+    @contextmanager
+    def locked(self, path=None):
+        """ Holds an advisory lock on the manifest so other dkdep processes cannot write it meanwhile. """
+        with open(manifestcache.lock_path(self.cachedir, path or self.path), "w") as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                print(f"Waiting for another process to release {lockfile.name}...")
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    @contextmanager
+    def batch(self):
+        """ Groups a set of mutations into a single write.  The manifest is locked and reloaded when the
+        (outermost) batch starts and calls to save within it are deferred till the batch ends, when the
+        manifest is written once if anything changed.  If the batch raises nothing is written.
+
+            with manifest.batch():
+                for name, url in packages:
+                    manifest.addpkg(name, url)
+        """
+        if self._batch_depth > 0:
+            self._batch_depth += 1
+            try: yield self
+            finally: self._batch_depth -= 1
+            return
+
+        with self.locked():
+            # pick up any changes made by others while we were not holding the lock
+            self.load()
+            self._dirty = False
+            self._batch_depth = 1
+            try:
+                yield self
+                if self._dirty: self.write()
+            finally:
+                self._batch_depth = 0
+                self._dirty = False
+
     def save(self, path=None):
+        """ Writes the manifest out.  Within a batch this is deferred till the batch ends. """
+        if self._batch_depth > 0 and path in (None, self.path):
+            self._dirty = True
+            return
+        with self.locked(path):
+            self.write(path)
+
+    def write(self, path=None):
+        """ Atomically replaces the manifest file with our contents.  Callers must hold the lock. """
         path = path or self.path
-        with open(path, "w") as outfile:
-            outfile.write(yamldump(self.deployment.to_json()))
+        contents = self.deployment.to_json()
+        dirname, basename = os.path.split(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=f".{basename}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as outfile:
+                outfile.write(yamldump(contents))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            if os.path.exists(path):
+                os.chmod(tmppath, stat.S_IMODE(os.stat(path).st_mode))
+            os.replace(tmppath, path)
+        except:
+            if os.path.exists(tmppath): os.remove(tmppath)
+            raise
+        manifestcache.store(self.cachedir, path, contents)
 
     def print(self):
         print(yamldump(self.deployment.to_json()))
@@ -36,56 +122,112 @@ class Manifest:
             sys.exit(1)
         return latest
 
+    @batched
     def newversion(self, version: str, headname=DEFAULT_MAIN):
         """ Creates a new version out of the last tagged version by adding and removing dependencies.   This can be called multiple times and each call before a tag is committed is collected and grouped into one. Also in a new version - until it is commited - the versions each dependent repo's version will be set to the version of repos in the parent version and for any added packages, their versions will be set to head. """
         version = self.deployment.new_version(version)
         self.save()
         return self
 
-    def commitversion(self, repodir=DEFAULT_REPO_FOLDER):
+    @batched
+    def commitversion(self, repodir=DEFAULT_REPO_FOLDER, jobs=DEFAULT_JOBS, mirrors=None):
         """ Commits the last version if it has not already been committed while freezing the version tags in the new version.  Also the commit will only succeed if there are actual changes in atleast one repo between the last version and the current version the repo is checked out to.  This allows us to take a repo "backward" in a new version of an entire deployment. """
         if not os.path.isdir(repodir): os.makedirs(repodir)
         latest = self.ensure_uncommitted()
 
         assert self.deployment.name, "name cannot be empty in the manifest file"
         # checkout all repos and ensure they are at the right versions
-        self.checkout(latest.versiontag, repodir)
+        self.checkout(latest.versiontag, repodir, jobs=jobs, mirrors=mirrors)
 
         # now see which ones have changed
         # if a package has changed - tag and set that as our pkg tag
         # otherwise use previous verion's pkg tag
         last_version = None
-        if len(self.deployment.versions) > 1:
-            last_version = self.deployment.versions[-2]
+        if self.deployment.num_versions > 1:
+            last_version = self.deployment.version_at(-2)
+        changes = self.detect_changes(latest, last_version, repodir, jobs)
         tagged_packages = []
-        for name,pkg in latest.packages.items():
-            create_tag = last_version is None
-            if not create_tag:
-                repopath = f"{repodir}/{pkg.name}"
-                last_version_tag = last_version.packages[name].versiontag
-                diff = local(f"cd {repopath} && git diff {last_version_tag}")
-                create_tag = diff.failed or diff.stdout.strip() != ""
-
-            if create_tag or last_version_tag.strip() in ("", "main", "master"):
-                pkg.versiontag = f"{self.deployment.name}_{name}_{str(time.time()).replace('.', '_')}"
-                # pkg.versiontag += f"{random.randint(0, 1000000000)}"
-                tagged_packages.append(pkg)
+        for name in list(latest.packages):
+            last_version_tag, changed, sha = changes[name]
+            if changed:
+                newtag = f"{self.deployment.name}_{name}_{str(time.time()).replace('.', '_')}"
+                # newtag += f"{random.randint(0, 1000000000)}"
+                tagged_packages.append(latest.set_package_tag(name, newtag, sha))
             else:
-                pkg.versiontag = last_version_tag
+                last_pkg = last_version.packages.get(name) if last_version else None
+                pkg = latest.packages[name]
+                if last_pkg and (last_pkg.repo_url, last_pkg.versiontag, last_pkg.sha, last_pkg.metadata) == (pkg.repo_url, last_version_tag, sha, pkg.metadata):
+                    # unchanged - share the last version's record instead of copying it
+                    latest.packages[name] = last_pkg
+                else:
+                    latest.set_package_tag(name, last_version_tag, sha)
 
         if not tagged_packages:
             print("No packages have changed.  Commit wont proceed.  Make some code changes and try again")
             sys.exit(0)
 
         latest.created_at = time.time()
-        for pkg in tagged_packages:
-            print(f"Creating tag {pkg.versiontag} for {pkg.name}")
-            repopath = f"{repodir}/{pkg.name}"
-            local(f"cd {repopath} && git tag -a {pkg.versiontag} -m {pkg.versiontag} && git push origin --tags")
+        self.tag_packages(tagged_packages, repodir, jobs)
         # Finally save our manifest
         self.save()
         return self
 
+    def detect_changes(self, version, last_version, repodir=DEFAULT_REPO_FOLDER, jobs=DEFAULT_JOBS):
+        """ Finds out which packages in version (already checked out in repodir) have changed since last_version.
+        Returns a dict of package name -> (last version's tag, changed, sha of the commit the package
+        will be pinned to - HEAD if it changed and the last tag's commit otherwise).  Packages that are
+        new or whose last tag was a branch are always considered changed.  Trees are compared by id so
+        no diff is ever computed or buffered and everything is resolved with one git call per package. """
+        from dkdeputils.gitutils import rev_parse
+        def check(pkg, log):
+            repopath = f"{repodir}/{pkg.name}"
+            last_pkg = last_version.packages.get(pkg.name) if last_version else None
+            last_tag = last_pkg.versiontag.strip() if last_pkg else ""
+            if last_tag not in ("", "main", "master"):
+                ids = rev_parse(repopath, "HEAD", "HEAD^{tree}", f"{last_tag}^{{commit}}", f"{last_tag}^{{tree}}")
+                if ids:
+                    head, head_tree, last_commit, last_tree = ids
+                    changed = head_tree != last_tree
+                    return last_tag, changed, head if changed else last_commit
+            ids = rev_parse(repopath, "HEAD")
+            if not ids: raise Exception(f"Could not resolve HEAD in {repopath}")
+            return last_tag, True, ids[0]
+        results = run_parallel(check, version.packages.values(), jobs, key=lambda pkg: pkg.name, tag="package")
+        if report_failures("Change detection", results):
+            sys.exit(1)
+        for r in results:
+            last_tag, changed, sha = r.value
+            print(f"{r.key}: {'changed' if changed else 'unchanged'} since {last_tag or '<none>'}")
+        return {r.key: r.value for r in results}
+
+    def tag_packages(self, packages, repodir=DEFAULT_REPO_FOLDER, jobs=DEFAULT_JOBS):
+        """ Creates each package's versiontag in its repo and pushes only that tag to origin, for
+        upto `jobs` packages concurrently.  If any of them fail all the tags that were created are
+        deleted again (locally and on origin) and we exit so the manifest is never saved half committed. """
+        from dkdeputils.gitutils import create_tag, push_tag, delete_tag
+        def tag(pkg, log):
+            repopath = f"{repodir}/{pkg.name}"
+            log(f"Creating tag {pkg.versiontag} for {pkg.name}")
+            create_tag(repopath, pkg.versiontag)
+            try:
+                push_tag(repopath, pkg.versiontag)
+            except:
+                delete_tag(repopath, pkg.versiontag)
+                raise
+        results = run_parallel(tag, packages, jobs, key=lambda pkg: pkg.name, tag="package")
+        if not report_failures("Tagging", results):
+            return results
+
+        def untag(pkg, log):
+            log(f"Removing tag {pkg.versiontag} from {pkg.name}")
+            delete_tag(f"{repodir}/{pkg.name}", pkg.versiontag, remote="origin")
+        created = [r.item for r in results if r.ok]
+        if created:
+            print("Rolling back tags already created...")
+            report_failures("Rollback", run_parallel(untag, created, jobs, key=lambda pkg: pkg.name, tag="package"))
+        sys.exit(1)
+
+    @batched
     def removepkg(self, pkgname):
         """ Removes/Updates a package to the latest version (only if it is uncommitted) of the deployemtn with the name, repo_url and tag.  If the latest version is committed then this is ignored with a warning. """
         latest = self.ensure_uncommitted()
@@ -93,6 +235,7 @@ class Manifest:
         self.save()
         return self
 
+    @batched
     def addpkg(self, pkgname, repo_url, tag=DEFAULT_MAIN):
         """ Adds/Updates a package to the latest version (only if it is uncommitted) of the deployemtn with the name, repo_url and tag.  If the latest version is committed then this is ignored with a warning. """
         latest = self.ensure_uncommitted()
@@ -100,13 +243,77 @@ class Manifest:
         self.save()
         return self
 
-    def checkout(self, version: str, repodir=DEFAULT_REPO_FOLDER, group=None):
-        """ Checks all the repos required for a particular version of our deployment to the version as specified in the dependency section in the manifest (for the particular version).  "head" is a special version that brings all repos to the latest/head commit tag. """
-        from dkdeputils.utils import checkout_repo
-        version = self.deployment.get_version(version)
+    def checkout(self, version: str, repodir=DEFAULT_REPO_FOLDER, group=None, jobs=DEFAULT_JOBS, mirrors=None, snapshots=None):
+        """ Checks all the repos required for a particular version of our deployment to the version as specified in the dependency section in the manifest (for the particular version).  "head" is a special version that brings all repos to the latest/head commit tag.  Upto `jobs` repos are checked out concurrently and if any of them fail a summary of the failed repos is printed and we exit.  If a MirrorCache is given local checkouts are made from (and fetch from) its mirrors.  If a SnapshotCache is given along with a group, snapshots of the packages are distributed to the hosts instead of each host checking out the repos (see distribute). """
+        from dkdeputils.utils import checkout_repo, open_connections
+        versiontag = version
+        version = self.deployment.get_version(versiontag)
+        if not version:
+            print(f"Version {versiontag} not found in manifest.")
+            sys.exit(1)
         print("Checking out version: ", version.versiontag)
-        for name,pkg in version.packages.items():
-            checkout_repo(group, pkg.name, pkg.repo_url, pkg.versiontag, repodir, DEFAULT_MAIN)
+        # Each package's checkout is a single command per host over one shared connection per host
+        if group: open_connections(group)
+        if group and snapshots:
+            return self.distribute(version, repodir, group, snapshots, jobs)
+        def checkout_pkg(pkg, log):
+            checkout_repo(group, pkg.name, pkg.repo_url, pkg.versiontag, repodir, DEFAULT_MAIN, log=log, hide=jobs > 1, mirrors=mirrors, sha=pkg.sha)
+        results = run_parallel(checkout_pkg, version.packages.values(), jobs, key=lambda pkg: pkg.name, tag="package")
+        if mirrors: mirrors.evict()
+        if report_failures("Checkout", results):
+            sys.exit(1)
+        return results
+
+    def distribute(self, version, repodir, group, snapshots, jobs=DEFAULT_JOBS):
+        """ Builds (or reuses) a snapshot of each package in version, once, and copies them to every
+        host in the group that does not already have them, upto `jobs` packages and hosts at a time.
+        Hosts never talk to the repos themselves.  Exits if any package or host fails. """
+        from dkdeputils.snapshots import distribute
+        built = self.build_snapshots(version, snapshots, jobs)
+        results = distribute(group, built, repodir, jobs)
+        if report_failures("Distribution", results):
+            sys.exit(1)
+        return results
+
+    def build_snapshots(self, version, snapshots, jobs=DEFAULT_JOBS):
+        """ Builds (or reuses) the Snapshot of each package in version, upto `jobs` at a time, and
+        returns them.  Exits if any of them could not be built. """
+        def build(pkg, log):
+            return snapshots.build(pkg.name, pkg.repo_url, pkg.versiontag, DEFAULT_MAIN, log, sha=pkg.sha)
+        results = run_parallel(build, version.packages.values(), jobs, key=lambda pkg: pkg.name, tag="package")
+        if report_failures("Snapshot", results):
+            sys.exit(1)
+        built = [r.value for r in results]
+        snapshots.evict(keep=[s.path for s in built])
+        return built
+
+    def deploy(self, version: str, hosts, repodir=DEFAULT_REPO_FOLDER, batch_size=None, max_in_flight=None, max_failures=0,
+               host_check="", wave_check="", snapshots=None, jobs=DEFAULT_JOBS, report=""):
+        """ Rolls a version out to hosts (see rollout.load_inventory) in waves (see rollout.rollout).  If a
+        SnapshotCache is given the package snapshots are built once and installed on the hosts, otherwise
+        each host checks out the packages itself.  Prints a per host report (and writes it as json to
+        report if given) and exits if the rollout was stopped or any host failed. """
+        from dkdeputils import rollout
+        versiontag = version
+        version = self.deployment.get_version(versiontag)
+        if not version:
+            print(f"Version {versiontag} not found in manifest.")
+            sys.exit(1)
+        if not hosts:
+            print("No hosts to deploy to.")
+            sys.exit(1)
+        built = self.build_snapshots(version, snapshots, jobs) if snapshots else None
+        results, completed = rollout.rollout(version, hosts, repodir, batch_size or rollout.DEFAULT_BATCH_SIZE,
+                                             max_in_flight or rollout.DEFAULT_MAX_IN_FLIGHT, max_failures,
+                                             host_check, wave_check, built, DEFAULT_MAIN)
+        rollout.print_report(results)
+        if report:
+            with open(report, "w") as outfile:
+                json.dump({"version": version.versiontag, "completed": completed,
+                           "hosts": [r.to_json() for r in results]}, outfile, indent=2)
+        if not completed or any(r.status == "failed" for r in results):
+            sys.exit(1)
+        return results
 
     def describe(self, version: str=""):
         """ Describe a particular version (present in the manifest)
@@ -117,6 +324,66 @@ class Manifest:
         else:
             self.print()
 
+    def versions_with_package(self, pkgname: str, tag: str=""):
+        """ Prints the versions that contain a package (at a particular package version tag if given). """
+        versions = self.deployment.versions_with_package(pkgname, tag or None)
+        for v in versions:
+            print(f"{v.versiontag}: {v.packages[pkgname].versiontag}")
+        return versions
+
+    def status(self, version: str="", repodir=DEFAULT_REPO_FOLDER, jobs=DEFAULT_JOBS, as_json=False):
+        """ Prints how each package's checkout in repodir compares to a version (the latest one by default)
+        - whether HEAD is at the commit the version expects, how far ahead/behind of it it is and how many
+        files are changed - as a table or as json.  Only local git plumbing is used (upto `jobs` repos at a
+        time) so nothing is changed or fetched.  A package is "unknown" if the expected commit is not
+        present locally.  In shallow clones ahead/behind only count the commits that were fetched.
+        Returns the list of per package statuses. """
+        from dkdeputils.gitutils import resolve_commit, worktree_status, ahead_behind, has_commit
+        if version:
+            v = self.deployment.get_version(version)
+        else:
+            v = self.deployment.version_at(-1) if self.deployment.num_versions else None
+        if not v:
+            print(f"Version {version} not found in manifest." if version else "No versions found in manifest.")
+            sys.exit(1)
+
+        def inspect(pkg, log):
+            repopath = f"{repodir}/{pkg.name}"
+            tag = DEFAULT_MAIN if pkg.versiontag.lower() in ("", "head") else pkg.versiontag
+            out = {"package": pkg.name, "expected": tag, "expected_sha": pkg.sha, "head": "", "branch": None,
+                   "state": "missing", "changed_files": 0, "ahead": 0, "behind": 0}
+            if not os.path.exists(os.path.join(repopath, ".git")):
+                return out
+            out["head"], out["branch"], out["changed_files"] = worktree_status(repopath)
+            expected = out["expected_sha"] = pkg.sha or resolve_commit(repopath, tag)
+            if not expected or not out["head"] or not has_commit(repopath, expected):
+                out["state"] = "unknown"
+            elif out["head"] == expected:
+                out["state"] = "current"
+            else:
+                out["ahead"], out["behind"] = ahead_behind(repopath, expected)
+                out["state"] = "diverged" if out["ahead"] and out["behind"] else ("ahead" if out["ahead"] else "behind")
+            return out
+        results = run_parallel(inspect, v.packages.values(), jobs, key=lambda pkg: pkg.name, tag="package")
+        report_failures("Status", results)
+        statuses = [r.value if r.ok else {"package": r.key, "state": "error", "error": str(r.error)} for r in results]
+
+        if as_json:
+            print(json.dumps({"version": v.versiontag, "repodir": repodir, "packages": statuses}, indent=2))
+            return statuses
+        width = max([len(s["package"]) for s in statuses] + [7])
+        tagwidth = max([len(s.get("expected", "")) for s in statuses] + [8])
+        print(f"{'PACKAGE':{width}s}  {'EXPECTED':{tagwidth}s}  {'SHA':12s}  {'HEAD':12s}  {'STATE':9s}  CHANGED  AHEAD  BEHIND")
+        for s in statuses:
+            if s["state"] == "error":
+                print(f"{s['package']:{width}s}  {'':{tagwidth}s}  {'':12s}  {'':12s}  error      {s['error']}")
+                continue
+            print(f"{s['package']:{width}s}  {s['expected']:{tagwidth}s}  {s['expected_sha'][:12]:12s}  {s['head'][:12]:12s}  "
+                  f"{s['state']:9s}  {s['changed_files']:7d}  {s['ahead']:5d}  {s['behind']:6d}")
+        stale = [s for s in statuses if s["state"] != "current" or s.get("changed_files")]
+        print(f"{len(statuses) - len(stale)} of {len(statuses)} packages are clean and at version {v.versiontag}")
+        return statuses
+
     def add_to_locals(self, L):
         from fabric import task
         @task
@@ -127,8 +394,8 @@ class Manifest:
             return self.newversion(version, headname)
 
         @task
-        def commitversion(ctx, repodir=DEFAULT_REPO_FOLDER):
-            return self.commitversion(repodir=DEFAULT_REPO_FOLDER)
+        def commitversion(ctx, repodir=DEFAULT_REPO_FOLDER, jobs=DEFAULT_JOBS):
+            return self.commitversion(repodir=DEFAULT_REPO_FOLDER, jobs=int(jobs))
 
         @task
         def removepkg(ctx, pkgname):
@@ -139,8 +406,8 @@ class Manifest:
             return self.addpkg(pkgname, repo_url, tag)
 
         @task
-        def checkout(ctx, version: str, repodir=DEFAULT_REPO_FOLDER):
-            return self.checkout(version, repodir)
+        def checkout(ctx, version: str, repodir=DEFAULT_REPO_FOLDER, jobs=DEFAULT_JOBS):
+            return self.checkout(version, repodir, jobs=int(jobs))
 
         @task
         def describe(ctx, version: str=""): return self.describe(version)
@@ -168,25 +435,114 @@ class Deployment:
     """
     def __init__(self, name: str="", versions: List["Version"]=None, **metadata):
         self.name = name
-        self.versions = versions or []
         self.metadata = metadata
+        self.clear_versions()
+        for v in versions or []:
+            self.add_version(v)
+
+    def clear_versions(self):
+        # Versions are kept in order either as Version objects or as the raw json they were loaded
+        # from.  Raw entries are only turned into Versions when they are first accessed.
+        self._versions = []
+        # versiontag -> position in self._versions
+        self._index = {}
+        # package name -> package versiontag -> [versiontags of the committed versions with it]
+        # Built on first use and dropped whenever versions are added or removed.
+        self._package_index = None
+
+    @property
+    def num_versions(self):
+        return len(self._versions)
+
+    @property
+    def versions(self) -> List["Version"]:
+        """ All versions in order.  Note this parses every version - prefer version_at/get_version. """
+        return [self.version_at(i) for i in range(len(self._versions))]
+
+    def version_at(self, index: int) -> "Version":
+        v = self._versions[index]
+        if not isinstance(v, Version):
+            v = self._versions[index] = Version().from_json(v)
+        return v
 
     def get_version(self, versiontag):
         """ Get a version by the given tag if it exists. """
-        for v in self.versions:
-            if v.versiontag == versiontag:
-                return v
-        return None
+        index = self._index.get(versiontag)
+        if index is None: return None
+        return self.version_at(index)
+
+    def add_version(self, version):
+        """ Appends a Version (or its raw json) to our list of versions. """
+        versiontag = self._versiontag_at(version)
+        if versiontag in self._index:
+            raise Exception(f"Version {versiontag} already exists in deployment {self.name}")
+        return self._append_version(version)
+
+    def _append_version(self, version):
+        # A manifest may (by hand editing) list a versiontag more than once.  The entries are all kept
+        # but lookups by tag find the first one.
+        self._index.setdefault(self._versiontag_at(version), len(self._versions))
+        self._versions.append(version)
+        self._package_index = None
+        return version
+
+    @staticmethod
+    def _versiontag_at(version):
+        return version.versiontag if isinstance(version, Version) else version["versiontag"]
+
+    def remove_version(self, versiontag):
+        """ Removes a version by its tag if it exists. """
+        index = self._index.pop(versiontag, None)
+        if index is None: return None
+        version = self.version_at(index)
+        del self._versions[index]
+        for tag,i in self._index.items():
+            if i > index: self._index[tag] = i - 1
+        # A later entry with the same tag (see _append_version) is now the one found by it
+        for i in range(index, len(self._versions)):
+            if self._versiontag_at(self._versions[i]) == versiontag:
+                self._index[versiontag] = i
+                break
+        self._package_index = None
+        return version
+
+    def versions_with_package(self, pkgname, versiontag=None) -> List["Version"]:
+        """ Returns the versions that contain the given package (at the given package versiontag if provided). """
+        if self._package_index is None:
+            self._package_index = {}
+            for i in range(len(self._versions)):
+                for name, tag in self._version_packages(i, committed_only=True):
+                    self._package_index.setdefault(name, {}).setdefault(tag, []).append(i)
+        bytag = self._package_index.get(pkgname, {})
+        indexes = bytag.get(versiontag, []) if versiontag is not None else [i for ids in bytag.values() for i in ids]
+        # The uncommitted version can still change so it is not indexed and checked directly
+        last = len(self._versions) - 1
+        if last >= 0 and last not in indexes:
+            for name, tag in self._version_packages(last):
+                if name == pkgname and versiontag in (None, tag):
+                    indexes = indexes + [last]
+        return [self.version_at(i) for i in sorted(indexes)]
+
+    def _version_packages(self, index, committed_only=False):
+        """ (name, versiontag) of each package in a version without parsing it if it is still raw json. """
+        v = self._versions[index]
+        if isinstance(v, Version):
+            if committed_only and not v.created_at: return []
+            return [(p.name, p.versiontag) for p in v.packages.values()]
+        if committed_only and not v.get("created_at"): return []
+        return [(p["name"], p["versiontag"]) for p in v.get("packages", [])]
 
     def from_json(self, obj):
         self.name = obj["name"]
         self.metadata = obj.get("metadata", {})
-        self.versions = [Version().from_json(v) for v in obj.get("versions", [])]
+        self.clear_versions()
+        for v in obj.get("versions", []):
+            self._append_version(v)
         return self
 
     def to_json(self):
         out = {"name": self.name,
-               "versions": [v.to_json() for v in self.versions]}
+               "versions": [(v if isinstance(v, Version) else Version().from_json(v)).to_json() for v in self._versions]}
         if self.metadata:
            out["metadata"] = self.metadata
         return out
@@ -197,8 +553,8 @@ class Deployment:
             return
 
         last_version = None
-        if self.versions:
-            last_version = self.versions[-1]
+        if self._versions:
+            last_version = self.version_at(-1)
             if not last_version.created_at:
                 # Hasnt been committed yet so return this
                 return last_version
@@ -208,16 +564,19 @@ class Deployment:
             new_version.name = new_version.versiontag = versiontag
         else:
             new_version = Version(versiontag)
-        self.versions.append(new_version)
+        self.add_version(new_version)
         return new_version
 
     @property
     def uncommitted_version(self):
-        if not self.versions: return None
-        if self.versions[-1].created_at: return None
-        return self.versions[-1]
+        if not self._versions: return None
+        latest = self.version_at(-1)
+        if latest.created_at: return None
+        return latest
 
 class Version:
+    __slots__ = ("versiontag", "name", "packages", "metadata", "created_at")
+
     def __init__(self, versiontag: str="", name: str="", packages: Dict[str, "Package"]=None, **metadata):
         self.versiontag = versiontag
         self.name = name or versiontag
@@ -226,9 +585,11 @@ class Version:
         self.created_at = None
 
     def clone(self, reset=False):
+        """ Clones this version.  Package records are shared with the clone and are only copied when
+        they need to change (eg when reset clears their tags). """
         out = Version(self.versiontag, **self.metadata)
         for k,pkg in self.packages.items():
-            out.packages[k] = pkg.clone(reset)
+            out.packages[k] = pkg.with_versiontag("", "") if reset else pkg
         return out
 
     def from_json(self, obj):
@@ -240,7 +601,7 @@ class Version:
             self.created_at = obj["created_at"]
         self.packages = {}
         for p in obj.get("packages", []):
-            self.packages[p["name"]] = Package().from_json(p)
+            self.packages[p["name"]] = Package.from_json_shared(p)
         return self
 
     def to_json(self):
@@ -261,29 +622,76 @@ class Version:
         if pkgname in self.packages:
             del self.packages[pkgname]
 
+    def set_package_tag(self, pkgname: str, versiontag: str, sha: str=None):
+        """ Sets the versiontag (and the commit it resolves to) of one of our packages.  Without a sha
+        the package keeps its pin if the tag is unchanged and is unpinned otherwise.  Package records
+        can be shared with other versions so the record is replaced rather than modified. """
+        pkg = self.packages[pkgname]
+        if sha is None and versiontag != pkg.versiontag: sha = ""
+        pkg = self.packages[pkgname] = pkg.with_versiontag(versiontag, sha)
+        return pkg
+
+# Identical package records (which most versions in a long history have) share one object
+_package_pool = weakref.WeakValueDictionary()
+
 class Package:
     """ A package is the smallest unit that can be bundled, versioned, packaged as part of a deployment.
     These are used to maintain how we think about deploying software or libraries in a platform/vendor agnostic way.
     For instance as a team you may be maintaining 10 packges or libraries or repos.
     Out of these 10, 3 could be used to deploy service A, 5 for service B and so on.
     The services themselves may depend on different versions of these packages.
+
+    Package records are shared between versions (and their metadata between packages) so treat them
+    as immutable - use with_versiontag/Version.set_package_tag instead of modifying them in place.
+
+    Committed packages also record the sha of the commit their versiontag resolved to so checkouts
+    can tell whether they already have it without asking the repo.
     """
-    def __init__(self, name: str="", repo_url: str="", versiontag: str="", **metadata):
-        self.name = name
-        self.repo_url = repo_url
+    __slots__ = ("name", "repo_url", "versiontag", "sha", "metadata", "__weakref__")
+
+    def __init__(self, name: str="", repo_url: str="", versiontag: str="", sha: str="", **metadata):
+        self.name = sys.intern(name)
+        self.repo_url = sys.intern(repo_url)
         self.versiontag = versiontag
+        self.sha = sha
         self.metadata = metadata
 
     def clone(self, reset=False):
-        out = Package(self.name, self.repo_url, self.versiontag, **self.metadata)
-        if reset:
-            out.versiontag = ""
+        return self.with_versiontag("", "") if reset else self.with_versiontag(self.versiontag)
+
+    def with_versiontag(self, versiontag: str, sha: str=None):
+        """ Returns a package like this one but at versiontag and sha (this one itself if they are the same,
+        or a shared identical record if there is one).  A sha of None keeps the current one - pass "" to clear the pin. """
+        if sha is None: sha = self.sha
+        if versiontag == self.versiontag and sha == self.sha: return self
+        key = (self.name, self.repo_url, versiontag, sha)
+        out = None if self.metadata else _package_pool.get(key)
+        if out is None:
+            out = Package.__new__(Package)
+            out.name = self.name
+            out.repo_url = self.repo_url
+            out.versiontag = versiontag
+            out.sha = sha
+            out.metadata = self.metadata
+            if not self.metadata: _package_pool[key] = out
         return out
 
+    @classmethod
+    def from_json_shared(cls, obj):
+        """ Like from_json but returns a shared record if an identical package has already been loaded. """
+        if obj.get("metadata"):
+            return cls().from_json(obj)
+        key = (obj["name"], obj["repo_url"], obj["versiontag"], obj.get("sha", ""))
+        pkg = _package_pool.get(key)
+        if pkg is None:
+            pkg = _package_pool[key] = cls().from_json(obj)
+        return pkg
+
     def from_json(self, obj):
-        self.name = obj["name"]
-        self.repo_url = obj["repo_url"]
+        self.name = sys.intern(obj["name"])
+        self.repo_url = sys.intern(obj["repo_url"])
         self.versiontag = obj["versiontag"]
+        self.sha = obj.get("sha", "")
         self.metadata = obj.get("metadata", {})
         return self
 
@@ -291,6 +699,8 @@ class Package:
         out = {"name": self.name,
                "repo_url": self.repo_url,
                "versiontag": self.versiontag}
+        if self.sha:
+            out["sha"] = self.sha
         if self.metadata:
            out["metadata"] = self.metadata
         return out
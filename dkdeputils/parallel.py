@@ -0,0 +1,88 @@
+import sys, threading, traceback
+from dkdeputils import profiling
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_JOBS = 8
+
+# Guards stdout so that the buffered output of one job is never interleaved with another's
+print_lock = threading.Lock()
+
+class JobLog:
+    """ Collects the output of a single job so it can be printed as one contiguous block.
+    When the log is not buffered lines are printed as they come (used when running serially). """
+    def __init__(self, key, buffered=True):
+        self.key = key
+        self.buffered = buffered
+        self.lines = []
+
+    def __call__(self, *args):
+        line = " ".join(str(a) for a in args)
+        if self.buffered:
+            self.lines.append(line)
+        else:
+            with print_lock: print(line)
+
+    def flush(self):
+        if not self.lines: return
+        with print_lock:
+            print(f"----- {self.key} -----")
+            print("\n".join(self.lines))
+            sys.stdout.flush()
+        self.lines = []
+
+class JobResult:
+    def __init__(self, key, item, value=None, error=None):
+        self.key = key
+        self.item = item
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def run_parallel(func, items, jobs=DEFAULT_JOBS, key=str, tag=None):
+    """ Calls func(item, log) for every item on a pool of at most `jobs` threads.
+    Each job gets its own JobLog whose output is printed in one block when the job finishes.
+    When profiling, each job is recorded as a span and if tag is "package" or "host" the spans
+    recorded within the job are attributed to that package or host (the job's key).
+    Exceptions do not stop other jobs - they are captured in the returned JobResults which
+    are in the same order as items. """
+    items = list(items)
+    jobs = max(1, min(jobs or 1, len(items) or 1))
+    buffered = jobs > 1
+
+    def runjob(item):
+        k = key(item)
+        log = JobLog(k, buffered)
+        try:
+            with profiling.span("job", str(k)), profiling.tagged(**({tag: str(k)} if tag else {})):
+                result = JobResult(k, item, value=func(item, log))
+        except Exception as exc:
+            log(f"Failed: {exc}")
+            if not buffered: log(traceback.format_exc())
+            result = JobResult(k, item, error=exc)
+        log.flush()
+        return result
+
+    if jobs == 1:
+        return [runjob(item) for item in items]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(runjob, items))
+
+def describe_error(exc):
+    """ One line description of an error - for failed commands this is the command and its exit code. """
+    res = getattr(exc, "result", None)
+    if res is not None and hasattr(res, "command"):
+        return f"'{res.command}' exited with code {res.exited}"
+    lines = str(exc).strip().splitlines()
+    return lines[0] if lines else repr(exc)
+
+def report_failures(action, results):
+    """ Prints a summary of the failed jobs in results and returns them. """
+    failed = [r for r in results if not r.ok]
+    if failed:
+        print(f"{action} failed for {len(failed)} of {len(results)}:")
+        for r in failed:
+            print(f"  {r.key}: {describe_error(r.error)}")
+    return failed
@@ -0,0 +1,178 @@
+""" Optional instrumentation of everything expensive dkdep does.  Once a Profiler is enabled every local
+command, remote (fabric) command, aws api call and parallel job is recorded as a span with its duration,
+exit status and output size.  When profiling is not enabled the wrappers here just call through. """
+import os, sys, json, time, threading
+from contextlib import contextmanager
+
+PROFILE_FORMATS = ("json", "chrome")
+DEFAULT_PROFILE_TOP = 10
+
+_profiler = None
+_context = threading.local()
+
+class Span:
+    __slots__ = ("kind", "command", "package", "host", "start", "duration", "exit", "output_bytes", "thread")
+
+    def __init__(self, kind, command, package=None, host=None):
+        self.kind = kind
+        self.command = command
+        self.package = package if package is not None else getattr(_context, "package", None)
+        self.host = host if host is not None else getattr(_context, "host", None)
+        self.start = time.perf_counter()
+        self.duration = 0
+        self.exit = 0
+        self.output_bytes = 0
+        self.thread = threading.get_ident()
+
+    def set_result(self, res):
+        """ Takes the exit status and output size from an invoke/fabric Result. """
+        self.exit = getattr(res, "exited", 0)
+        self.output_bytes = len(getattr(res, "stdout", "") or "") + len(getattr(res, "stderr", "") or "")
+
+    def set_error(self, exc):
+        res = getattr(exc, "result", None)
+        if res is not None and hasattr(res, "exited"):
+            self.set_result(res)
+        else:
+            self.exit = -1
+
+    def to_json(self, origin=0):
+        return {"kind": self.kind, "command": self.command, "package": self.package, "host": self.host,
+                "start": round(self.start - origin, 6), "duration": round(self.duration, 6),
+                "exit": self.exit, "output_bytes": self.output_bytes, "thread": self.thread}
+
+class Profiler:
+    def __init__(self, name=""):
+        self.name = name or " ".join(os.path.basename(a) if i == 0 else a for i,a in enumerate(sys.argv))
+        self.origin = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        with self.lock: self.spans.append(span)
+
+    def to_json(self):
+        return {"command": self.name, "started_at": self.started_at,
+                "duration": round(time.perf_counter() - self.origin, 6), "pid": os.getpid(),
+                "spans": [s.to_json(self.origin) for s in self.spans]}
+
+    def to_chrome_trace(self):
+        """ The spans in the Trace Event Format understood by chrome://tracing and ui.perfetto.dev. """
+        pid = os.getpid()
+        events = [{"name": self.name, "cat": "dkdep", "ph": "X", "ts": 0, "pid": pid, "tid": threading.main_thread().ident,
+                   "dur": round((time.perf_counter() - self.origin) * 1e6)}]
+        for s in self.spans:
+            args = {k: v for k,v in s.to_json(self.origin).items() if k in ("command", "package", "host", "exit", "output_bytes") and v is not None}
+            events.append({"name": s.command[:80], "cat": s.kind, "ph": "X", "pid": pid, "tid": s.thread,
+                           "ts": round((s.start - self.origin) * 1e6), "dur": round(s.duration * 1e6), "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path, format="json"):
+        out = self.to_chrome_trace() if format == "chrome" else self.to_json()
+        with open(path, "w") as outfile:
+            json.dump(out, outfile, indent=1)
+
+    def summary(self, top=DEFAULT_PROFILE_TOP, file=sys.stderr):
+        """ Prints totals per kind of span and the top slowest spans (not counting jobs, which only
+        group the spans of their commands). """
+        print(f"Profile of '{self.name}': {time.perf_counter() - self.origin:.2f}s, {len(self.spans)} spans", file=file)
+        kinds = {}
+        for s in self.spans:
+            count, total, nbytes, failed = kinds.get(s.kind, (0, 0, 0, 0))
+            kinds[s.kind] = (count + 1, total + s.duration, nbytes + s.output_bytes, failed + (s.exit != 0))
+        for kind, (count, total, nbytes, failed) in sorted(kinds.items()):
+            print(f"  {kind:8s} {count:6d} spans  {total:9.2f}s  {nbytes:10d} bytes  {failed} failed", file=file)
+        slowest = sorted((s for s in self.spans if s.kind != "job"), key=lambda s: s.duration, reverse=True)[:top]
+        if slowest:
+            print(f"Slowest {len(slowest)}:", file=file)
+        for s in slowest:
+            where = "/".join(x for x in (s.host, s.package) if x)
+            command = " ".join(s.command.split())
+            print(f"  {s.duration:8.3f}s  {s.kind:6s} {where[:30]:30s} exit={s.exit:<3d} {command[:100]}", file=file)
+
+    def finish(self, path, format="json", top=DEFAULT_PROFILE_TOP):
+        self.write(path, format)
+        self.summary(top)
+        print(f"Profile written to {path}", file=sys.stderr)
+
+def enable(name=""):
+    """ Starts recording spans (for the rest of the process) and returns the Profiler. """
+    global _profiler
+    _profiler = Profiler(name)
+    return _profiler
+
+def disable():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def active():
+    return _profiler
+
+@contextmanager
+def tagged(package=None, host=None):
+    """ Attributes the spans recorded by this thread within the block to a package and/or host. """
+    old = (getattr(_context, "package", None), getattr(_context, "host", None))
+    if package is not None: _context.package = package
+    if host is not None: _context.host = host
+    try:
+        yield
+    finally:
+        _context.package, _context.host = old
+
+@contextmanager
+def span(kind, command, package=None, host=None):
+    """ Records the block as a span.  Yields the Span (or None when not profiling) so the caller
+    can set its result. """
+    profiler = _profiler
+    if not profiler:
+        yield None
+        return
+    s = Span(kind, command, package, host)
+    try:
+        yield s
+    except BaseException as exc:
+        s.set_error(exc)
+        raise
+    finally:
+        s.duration = time.perf_counter() - s.start
+        profiler.record(s)
+
+def local(cmd, **kwargs):
+    """ invoke.run that records a "local" span. """
+    from invoke import run
+    with span("local", cmd) as s:
+        res = run(cmd, **kwargs)
+        if s: s.set_result(res)
+        return res
+
+def remote(conn, cmd, **kwargs):
+    """ conn.run (on a fabric Connection) that records a "remote" span for its host. """
+    with span("remote", cmd, host=conn.host) as s:
+        res = conn.run(cmd, **kwargs)
+        if s: s.set_result(res)
+        return res
+
+def group_run(group, cmd, **kwargs):
+    """ group.run (on a fabric Group) that records a "remote" span per host.  The hosts run concurrently
+    so each host's span covers the whole group run. """
+    profiler = _profiler
+    if not profiler:
+        return group.run(cmd, **kwargs)
+    start = time.perf_counter()
+    results = {}
+    try:
+        results = group.run(cmd, **kwargs)
+        return results
+    except Exception as exc:
+        results = getattr(exc, "result", None) or {}
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        for conn, res in results.items():
+            s = Span("remote", cmd, host=conn.host)
+            s.start, s.duration = start, duration
+            if isinstance(res, Exception): s.set_error(res)
+            else: s.set_result(res)
+            profiler.record(s)
@@ -0,0 +1,123 @@
+""" Rolling a version of the deployment out to a fleet of hosts in waves.  Hosts are deployed to a
+wave (of batch_size hosts) at a time with at most max_in_flight hosts being worked on at once.
+After each host is deployed an optional health check is run on it and after each wave an optional
+local health check is run for the whole wave.  The rollout stops once more than max_failures hosts
+have failed or a wave's health check fails. """
+import time, threading
+from dkdeputils.parallel import run_parallel, describe_error
+from dkdeputils.profiling import local, remote
+
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_MAX_IN_FLIGHT = 5
+
+def load_inventory(path):
+    """ Reads a host inventory - a yaml list of hosts (or a mapping with such a list under "hosts").
+    Each host is either a "[user@]host[:port]" string or a mapping with a host and optionally a
+    user and port.  Returns a list of dicts with host, user and port. """
+    from dkdeputils.models import yamlload
+    with open(path) as infile:
+        data = yamlload(infile.read()) or []
+    if isinstance(data, dict): data = data.get("hosts") or []
+    hosts = []
+    for entry in data:
+        if isinstance(entry, str):
+            entry = {"host": entry}
+        if not entry.get("host"):
+            raise Exception(f"Invalid host in inventory {path}: {entry}")
+        hosts.append({"host": entry["host"], "user": entry.get("user"), "port": entry.get("port")})
+    return hosts
+
+def parse_hosts(hosts):
+    """ Hosts from a comma separated list of "[user@]host[:port]" strings (in the form load_inventory returns). """
+    return [{"host": h.strip(), "user": None, "port": None} for h in hosts.split(",") if h.strip()]
+
+def waves(items, batch_size):
+    batch_size = max(1, batch_size or len(items) or 1)
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+class HostResult:
+    def __init__(self, host, wave, status="skipped", seconds=0, error=None, packages=None):
+        self.host = host
+        self.wave = wave
+        self.status = status
+        self.seconds = seconds
+        self.error = error
+        self.packages = packages or {}
+
+    def to_json(self):
+        return {"host": self.host, "wave": self.wave, "status": self.status, "seconds": round(self.seconds, 3),
+                "error": self.error, "packages": self.packages}
+
+def rollout(version, hosts, repodir, batch_size=DEFAULT_BATCH_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            max_failures=0, host_check="", wave_check="", snapshots=None, default_main="main", log=print):
+    """ Deploys version (a Version) to hosts (as returned by load_inventory) in waves.  If snapshots
+    (a list of already built Snapshots of the version's packages) is given they are installed on
+    each host, otherwise each host checks out the packages itself.  host_check is a command run on
+    each host after it is deployed and wave_check a local command run after each wave, with the
+    wave's hosts in $DKDEP_HOSTS.  Returns (a HostResult per host, whether the rollout completed). """
+    from fabric import Connection, SerialGroup
+    from dkdeputils.utils import checkout_repo_remote
+    from dkdeputils.snapshots import install_snapshots
+    hosts = list({h["host"]: h for h in hosts}.values())
+    batches = waves(hosts, batch_size)
+    results = {h["host"]: HostResult(h["host"], index + 1) for index, wave in enumerate(batches) for h in wave}
+    failures = [0]
+    lock = threading.Lock()
+
+    def deploy(entry, log):
+        result = results[entry["host"]]
+        with lock:
+            if failures[0] > max_failures: return "skipped"
+        start = time.perf_counter()
+        conn = Connection(entry["host"], user=entry["user"], port=entry["port"])
+        try:
+            if snapshots:
+                result.packages = install_snapshots(conn, snapshots, repodir, log)
+            else:
+                group = SerialGroup.from_connections([conn])
+                for pkg in version.packages.values():
+                    steps = checkout_repo_remote(group, pkg.name, pkg.repo_url, pkg.versiontag, repodir, default_main, log, pkg.sha)
+                    result.packages[pkg.name] = ",".join(s["step"] for s in steps[conn.host])
+            if host_check:
+                log(f"Checking health of {conn.host}")
+                remote(conn, host_check, hide=True)
+            result.status = "ok"
+        except Exception as exc:
+            result.status = "failed"
+            result.error = describe_error(exc)
+            with lock: failures[0] += 1
+            raise
+        finally:
+            # Do not keep every host's ssh session open for the rest of the rollout
+            conn.close()
+            result.seconds = time.perf_counter() - start
+        return result.status
+
+    for index, wave in enumerate(batches):
+        names = [h["host"] for h in wave]
+        log(f"Wave {index + 1}: deploying {version.versiontag} to {len(wave)} host(s) ({max_in_flight} at a time)")
+        run_parallel(deploy, wave, max_in_flight, key=lambda h: h["host"], tag="host")
+        if failures[0] > max_failures:
+            log(f"Stopping rollout: {failures[0]} host(s) failed (at most {max_failures} allowed)")
+            return list(results.values()), False
+        if wave_check:
+            log(f"Checking health of wave {index + 1}")
+            env = {"DKDEP_VERSION": version.versiontag, "DKDEP_WAVE": str(index + 1), "DKDEP_HOSTS": " ".join(names)}
+            res = local(wave_check, env=env, warn=True, hide=True)
+            if res.failed:
+                log(f"Stopping rollout: health check failed after wave {index + 1} (exit code {res.exited})")
+                if (res.stdout + res.stderr).strip(): log((res.stdout + res.stderr).strip())
+                return list(results.values()), False
+    return list(results.values()), True
+
+def print_report(results, log=print):
+    """ Prints a table of the per host results. """
+    width = max([len(r.host) for r in results] + [4])
+    log(f"{'HOST':{width}s}  WAVE  STATUS   SECONDS  ERROR")
+    for r in results:
+        log(f"{r.host:{width}s}  {r.wave:4d}  {r.status:7s}  {r.seconds:7.2f}  {r.error or ''}")
+    done = [r for r in results if r.status != "skipped"]
+    if done:
+        times = sorted(r.seconds for r in done)
+        log(f"{len([r for r in done if r.status == 'ok'])} ok, {len([r for r in done if r.status == 'failed'])} failed, "
+            f"{len(results) - len(done)} skipped.  Per host: median {times[len(times) // 2]:.2f}s, max {times[-1]:.2f}s")
@@ -1,5 +1,8 @@
 import typer, json, os, sys
-from dkdeputils import models
+from dkdeputils import models, profiling
+from dkdeputils.mirrors import MirrorCache, DEFAULT_MIRROR_CACHE, DEFAULT_MIRROR_CACHE_SIZE_MB
+from dkdeputils.manifestcache import DEFAULT_MANIFEST_CACHE
+from dkdeputils.snapshots import SnapshotCache, DEFAULT_SNAPSHOT_CACHE, DEFAULT_SNAPSHOT_CACHE_SIZE_MB
 
 app = typer.Typer(pretty_exceptions_show_locals=False)
 
@@ -7,11 +10,30 @@ app = typer.Typer(pretty_exceptions_show_locals=False)
 @app.callback()
 def common_params(ctx: typer.Context,
                   manifest_path: typer.FileText = typer.Option("./manifest", envvar="DepToolsManifestPath", help="Path to the manifest file containing deployment and version information"),
-                  repodir: str = typer.Option("/tmp/repos", envvar="DepToolsRepoDir", help="Default folder where repos are checked out during the commit process")):
+                  manifest_cache: str = typer.Option(DEFAULT_MANIFEST_CACHE, envvar="DepToolsManifestCache", help="Folder where parsed manifests are cached.  Set to empty to always parse the manifest"),
+                  repodir: str = typer.Option("/tmp/repos", envvar="DepToolsRepoDir", help="Default folder where repos are checked out during the commit process"),
+                  mirror_cache: str = typer.Option(DEFAULT_MIRROR_CACHE, envvar="DepToolsMirrorCache", help="Folder of bare repo mirrors that checkouts are made from.  Set to empty to clone directly from the repo urls"),
+                  mirror_cache_size: int = typer.Option(DEFAULT_MIRROR_CACHE_SIZE_MB, envvar="DepToolsMirrorCacheSize", help="Size in MB beyond which least recently used mirrors are evicted"),
+                  snapshot_cache: str = typer.Option(DEFAULT_SNAPSHOT_CACHE, envvar="DepToolsSnapshotCache", help="Folder where package snapshots distributed to hosts are built and cached"),
+                  snapshot_cache_size: int = typer.Option(DEFAULT_SNAPSHOT_CACHE_SIZE_MB, envvar="DepToolsSnapshotCacheSize", help="Size in MB beyond which least recently used snapshots are evicted"),
+                  profile: str = typer.Option("", envvar="DepToolsProfile", help="Record every command, remote command and aws call run and write the profile to this file"),
+                  profile_format: str = typer.Option("json", envvar="DepToolsProfileFormat", help="Format of the profile - json or chrome (a trace for chrome://tracing or ui.perfetto.dev)"),
+                  profile_top: int = typer.Option(profiling.DEFAULT_PROFILE_TOP, envvar="DepToolsProfileTop", help="Number of slowest spans to print when profiling")):
     assert ctx.obj is None
 
+    if profile:
+        if profile_format not in profiling.PROFILE_FORMATS:
+            print(f"Invalid profile format '{profile_format}'.  Must be one of: {', '.join(profiling.PROFILE_FORMATS)}")
+            sys.exit(1)
+        profiler = profiling.enable()
+        # Runs when the command finishes (even if it exits early)
+        ctx.call_on_close(lambda: profiler.finish(profile, profile_format, profile_top))
+
     # For now these are env vars and not params yet
+    mirrors = MirrorCache(mirror_cache, mirror_cache_size) if mirror_cache else None
     ctx.obj = {
         "repodir": repodir,
-        "manifest": models.Manifest(manifest_path.name)
+        "mirrors": mirrors,
+        "snapshots": SnapshotCache(snapshot_cache, mirrors, snapshot_cache_size),
+        "manifest": models.Manifest(manifest_path.name, manifest_cache)
     }
@@ -0,0 +1,152 @@
+""" Distribution of package snapshots to hosts.  Instead of every host cloning each package from its
+repo, a `git archive` of the package's tree is built once (locally, from a mirror) and cached under
+the tree's id, which is a hash of its contents.  The archives are then copied to the hosts that do
+not have them yet and unpacked next to the previous snapshots, and the package's folder (a symlink)
+is switched over to the new snapshot atomically. """
+import os, shlex
+from dkdeputils.parallel import DEFAULT_JOBS, run_parallel
+from dkdeputils.profiling import local, remote, span
+from dkdeputils.mirrors import MirrorCache
+
+DEFAULT_SNAPSHOT_CACHE = os.path.expanduser("~/.cache/dkdep/snapshots")
+DEFAULT_SNAPSHOT_CACHE_SIZE_MB = 2 * 1024
+# Folder (under the repodir on each host) where the unpacked snapshots are kept
+HOST_SNAPSHOT_FOLDER = ".dkdep-snapshots"
+
+class Snapshot:
+    __slots__ = ("name", "tree", "path")
+
+    def __init__(self, name, tree, path):
+        self.name = name
+        self.tree = tree
+        self.path = path
+
+    @property
+    def key(self):
+        return f"{self.name}@{self.tree}"
+
+class SnapshotCache:
+    """ Archives of package trees under root, named by their tree id.  Archives are built from the
+    repos' mirrors (in mirrors or, if not given, in a MirrorCache of our own) and the least recently
+    used ones are evicted once the cache grows beyond max_size_mb (which our own mirrors count towards). """
+    def __init__(self, root=DEFAULT_SNAPSHOT_CACHE, mirrors=None, max_size_mb=DEFAULT_SNAPSHOT_CACHE_SIZE_MB):
+        self.root = root
+        self.own_mirrors = mirrors is None
+        self.mirrors = mirrors or MirrorCache(os.path.join(root, "mirrors"), max_size_mb)
+        self.max_size_mb = max_size_mb
+
+    def archive_path(self, tree):
+        return os.path.join(self.root, f"{tree}.tar.gz")
+
+    def build(self, name, repo_url, versiontag, default_main="main", log=print, sha=""):
+        """ Returns the Snapshot of repo_url at versiontag (or at sha, the commit it was pinned to, if
+        given) only archiving it if no snapshot of the same tree has been built before. """
+        ref = sha or (default_main if versiontag.lower() in ("", "head") else versiontag)
+        with self.mirrors.using(repo_url, log) as mirror:
+            tree = local(f"git --git-dir={mirror} rev-parse --verify {shlex.quote(ref + '^{tree}')}", hide=True).stdout.strip()
+            path = self.archive_path(tree)
+            if os.path.isfile(path):
+                os.utime(path)
+                log(f"Using snapshot {tree[:12]} of {name}:{ref}")
+            else:
+                log(f"Building snapshot {tree[:12]} of {name}:{ref}")
+                os.makedirs(self.root, exist_ok=True)
+                tmppath = f"{path}.tmp{os.getpid()}"
+                local(f"git --git-dir={mirror} archive --format=tar.gz -o {tmppath} {tree}", hide=True)
+                os.replace(tmppath, path)
+        return Snapshot(name, tree, path)
+
+    def evict(self, keep=(), log=print):
+        """ Removes the least recently used archives (except those in keep) until the cache fits in
+        max_size_mb and then evicts mirrors - our own ones to fit in what the archives leave of it. """
+        if not os.path.isdir(self.root): return []
+        archives = [os.path.join(self.root, f) for f in os.listdir(self.root) if f.endswith(".tar.gz")]
+        total = sum(os.path.getsize(a) for a in archives)
+        evicted = []
+        for a in sorted(archives, key=os.path.getmtime):
+            if total <= self.max_size_mb * 1024 * 1024: break
+            if a in keep: continue
+            log(f"Evicting snapshot {a}")
+            total -= os.path.getsize(a)
+            os.remove(a)
+            evicted.append(a)
+        if self.own_mirrors:
+            self.mirrors.max_size_mb = max(0, self.max_size_mb - total / (1024 * 1024))
+        return evicted + self.mirrors.evict(log)
+
+# Prints the snapshots a host already has ("present <name>@<tree>") and the ones its package folders
+# currently point to ("current <name>@<tree>").
+HOST_PROBE_SCRIPT = """
+mkdir -p "$store" || exit 1
+for snap in $keys; do
+  [ -d "$store/$snap" ] && echo "present $snap"
+  [ "$(readlink "$repodir/${snap%@*}")" = "$store/$snap" ] && echo "current $snap"
+done
+true
+"""
+
+# Unpacks the uploaded archives (if not already unpacked) and switches each package folder over to
+# its snapshot by atomically replacing the symlink.  Older snapshots of the package are removed.
+HOST_INSTALL_SCRIPT = """
+set -e
+install() {
+  dest="$repodir/$1"; snap="$store/$1@$2"
+  if [ ! -d "$snap" ]; then
+    rm -rf "$snap.tmp"; mkdir -p "$snap.tmp"
+    tar -xzf "$snap.tar.gz" -C "$snap.tmp"
+    rm -f "$snap.tar.gz"
+    mv "$snap.tmp" "$snap"
+  fi
+  # a folder left by a git checkout is moved aside the first time
+  if [ -e "$dest" ] && [ ! -L "$dest" ]; then rm -rf "$dest.pre-snapshot"; mv "$dest" "$dest.pre-snapshot"; fi
+  ln -sfn "$snap" "$dest.tmp"
+  mv -Tf "$dest.tmp" "$dest"
+  for old in "$store/$1@"*; do [ "$old" = "$snap" ] || rm -rf "$old"; done
+  echo "$1: installed $2"
+}
+"""
+
+def host_script(template, repodir, **variables):
+    """ A command running the script with repodir, store (the host's snapshot folder) and the given
+    variables set as shell variables.  repodir may start with ~ (the remote user's home). """
+    from dkdeputils.utils import quote_remote_path
+    header = f"repodir={quote_remote_path(repodir)}\nstore={quote_remote_path(f'{repodir}/{HOST_SNAPSHOT_FOLDER}')}\n"
+    header += "".join(f"{k}={shlex.quote(v)}\n" for k,v in variables.items())
+    return f"bash -c {shlex.quote(header + template)}"
+
+def distribute(group, snapshots, repodir, jobs=DEFAULT_JOBS):
+    """ Makes repodir/<name> on every host in the group point to its Snapshot, for upto `jobs` hosts
+    concurrently.  Per host this takes one command to find out which snapshots it already has, an
+    upload of each archive it is missing and one command to unpack and switch over to them.
+    Hosts already on all the snapshots are left alone.  Returns the JobResults of the hosts
+    (each a dict of package name -> "unchanged", "switched" or "uploaded"). """
+    def install(conn, log):
+        return install_snapshots(conn, snapshots, repodir, log)
+    return run_parallel(install, list(group), jobs, key=lambda conn: conn.host, tag="host")
+
+def install_snapshots(conn, snapshots, repodir, log=print):
+    """ Makes repodir/<name> on one host (a fabric Connection) point to its Snapshot (see distribute).
+    Returns a dict of package name -> "unchanged", "switched" or "uploaded". """
+    from dkdeputils.utils import sftp_path
+    keys = " ".join(s.key for s in snapshots)
+    present, current = set(), set()
+    for line in remote(conn, host_script(HOST_PROBE_SCRIPT, repodir, keys=keys), hide=True).stdout.splitlines():
+        what, _, key = line.strip().partition(" ")
+        (present if what == "present" else current).add(key)
+    statuses = {}
+    for s in snapshots:
+        if s.key in current:
+            statuses[s.name] = "unchanged"
+        elif s.key in present:
+            statuses[s.name] = "switched"
+        else:
+            with span("upload", s.path, package=s.name, host=conn.host) as sp:
+                conn.put(s.path, remote=sftp_path(f"{repodir}/{HOST_SNAPSHOT_FOLDER}/{s.key}.tar.gz"))
+                if sp: sp.output_bytes = os.path.getsize(s.path)
+            statuses[s.name] = "uploaded"
+    changed = [s for s in snapshots if statuses[s.name] != "unchanged"]
+    if changed:
+        calls = "".join(f"install {shlex.quote(s.name)} {s.tree}\n" for s in changed)
+        remote(conn, host_script(HOST_INSTALL_SCRIPT + calls, repodir), hide=True)
+    log(f"{conn.host}: " + ", ".join(f"{name}={status}" for name, status in statuses.items()))
+    return statuses
@@ -1,68 +1,287 @@
 
-import os, traceback
-from invoke import run as local
+import os, io, base64, shlex, traceback, contextlib
+from dkdeputils.profiling import local, remote, group_run
 from fabric import task, Connection, SerialGroup, ThreadingGroup
+from fabric.exceptions import GroupException
+from dkdeputils.parallel import DEFAULT_JOBS, run_parallel, report_failures
+from dkdeputils.hostfacts import FactCache, FactProbe
+
+# Idempotently installs the github keys, known_hosts entry and ssh config on a host in one go.
+# Each step prints one "<what>: <status>" line for the per host report.
+GITHUB_SSH_BOOTSTRAP = """
+set -e
+umask 077
+mkdir -p ~/.ssh
+cd ~/.ssh
+install_key() {
+  if printf '%s' "$2" | base64 -d | cmp -s - "$1"; then echo "$1: unchanged"
+  else printf '%s' "$2" | base64 -d > "$1.tmp" && mv "$1.tmp" "$1" && echo "$1: installed"; fi
+}
+install_key github_rsa '{private_key}'
+install_key github_rsa.pub '{public_key}'
+chmod og-rw github_rsa*
+touch config known_hosts
+if ssh-keygen -F github.com -f known_hosts > /dev/null; then echo "known_hosts: unchanged"
+else ssh-keyscan github.com >> known_hosts 2> /dev/null; echo "known_hosts: added github.com"; fi
+if grep -qx "Host github.com" config; then echo "config: unchanged"
+else cat >> config <<'EOF'
+Host github.com
+  HostName github.com
+  User git
+  AddKeysToAgent yes
+  IdentityFile ~/.ssh/github_rsa
+  IdentitiesOnly yes
+EOF
+echo "config: added github.com"; fi
+"""
 
 @task
-def setup_ssh_in_group(ctx, group, keys_folder):
-    """ Ensures we have ssh access to github for downloading repos in the hosts. """
+def setup_ssh_in_group(ctx, group, keys_folder, jobs=DEFAULT_JOBS):
+    """ Ensures we have ssh access to github for downloading repos in the hosts.
+    A single script (carrying the key material) is piped to each host, upto `jobs` hosts at a time,
+    and a per host report of what changed is printed.  Returns a dict of host -> status lines. """
     print("Setting SSH and .github access keys...")
-    group.put(f"{keys_folder}/github_rsa", ".ssh/")
-    group.put(f"{keys_folder}/github_rsa.pub", ".ssh/")
-    group.run("chmod og-rw .ssh/github_rsa*")
-    group.run("touch .ssh/config")
-    group.run("ssh-keyscan github.com >> ~/.ssh/known_hosts")
-    group.get(".ssh/config", "/tmp/config")
-    config = open("/tmp/config").read().split("\n")
-
-    for l in config:
-        if l == "Host github.com": return
-
-    with open("/tmp/config", "a") as configfile:
-        configfile.write("Host github.com\n")
-        configfile.write("  HostName github.com\n")
-        configfile.write("  User git\n")
-        configfile.write("  AddKeysToAgent yes\n")
-        configfile.write("  IdentityFile ~/.ssh/github_rsa\n")
-        configfile.write("  IdentitiesOnly yes\n")
-    group.put("/tmp/config", ".ssh/config")
-
-def checkout_repo(group, name, repo_url, versiontag, repodir, default_main="main"):
+    script = GITHUB_SSH_BOOTSTRAP
+    for (placeholder, keyfile) in (("{private_key}", "github_rsa"), ("{public_key}", "github_rsa.pub")):
+        with open(f"{keys_folder}/{keyfile}", "rb") as infile:
+            keydata = base64.b64encode(infile.read()).decode()
+        script = script.replace(placeholder, keydata)
+
+    def bootstrap(conn, log):
+        res = remote(conn, "bash -s", in_stream=io.StringIO(script), hide=True)
+        lines = res.stdout.strip().splitlines()
+        for line in lines: log(line)
+        return lines
+    results = run_parallel(bootstrap, list(group), jobs, key=lambda conn: conn.host, tag="host")
+    if report_failures("SSH setup", results):
+        raise Exception("SSH setup failed on: " + ", ".join(r.key for r in results if not r.ok))
+    return {r.key: r.value for r in results}
+
+def log_output(log, res):
+    """ Sends the captured stdout/stderr of a (local or group) command result to log. """
+    results = res.values() if isinstance(res, dict) else [res]
+    for r in results:
+        text = (r.stdout + r.stderr).strip()
+        if text: log(text)
+
+def checkout_repo(group, name, repo_url, versiontag, repodir, default_main="main", log=print, hide=False, mirrors=None, sha=""):
+    """ Clones or updates the repo at repodir/name and checks it out to versiontag.
+    If a fabric group is given this is done on each of its hosts (see checkout_repo_remote).
+    When hide is set command output is captured and sent to log instead of the terminal.
+    For local checkouts, if a MirrorCache is given the repo is cloned and fetched from its mirror
+    so only the mirror ever talks to repo_url.
+    If sha (the commit versiontag was pinned to) is given nothing is done when it is already
+    checked out, it is checked out without fetching if the repo already has it and otherwise only
+    that tag is fetched (shallowly if the repo is shallow, as fresh pinned clones are). """
+    if group:
+        return checkout_repo_remote(group, name, repo_url, versiontag, repodir, default_main, log, sha)
+    from dkdeputils.gitutils import head_sha, has_commit, is_shallow
     repopath = f"{repodir}/{name}"
-    runner = local
-    if group: runner = group.run
-    direxists=False
-    try:
-        runner(f"cd {repopath}")
-        direxists=True
-    except:
-        pass
-    if direxists:
-        print(f"Checking out {repo_url}:{versiontag} -> {repopath}")
-        runner(f"cd {repopath} && git fetch")
-        runner(f"cd {repopath} && git checkout {versiontag}")
-        try:
-            runner(f"cd {repopath} && git pull --rebase")
-        except Exception as exc:
-            print("Rebase failed: ", traceback.format_exc())
-    else:
-        print(f"Cloning {repo_url}:{versiontag} -> {repopath}")
-        runner(f"git clone {repo_url} {repopath}")
+    def runner(cmd):
+        res = local(cmd, hide=hide)
+        if hide: log_output(log, res)
+        return res
+    direxists = os.path.isdir(repopath)
+    if sha and direxists:
+        if head_sha(repopath) == sha:
+            log(f"{repopath} is already at {versiontag} ({sha[:12]})")
+            return
+        if has_commit(repopath, sha):
+            log(f"Checking out {versiontag} ({sha[:12]}) -> {repopath}")
+            runner(f"cd {repopath} && git checkout {sha}")
+            return
+    # The mirror is locked (so no other process evicts it) till we are done fetching from it
+    with contextlib.ExitStack() as stack:
+        mirror = stack.enter_context(mirrors.using(repo_url, log)) if mirrors else None
+        tagref = shlex.quote(f"+refs/tags/{versiontag}:refs/tags/{versiontag}")
+        if direxists and sha:
+            log(f"Fetching {repo_url}:{versiontag} -> {repopath}")
+            depth = "--depth=1 " if is_shallow(repopath) else ""
+            runner(f"cd {repopath} && git fetch {depth}{mirror or 'origin'} {tagref}")
+        elif direxists:
+            log(f"Checking out {repo_url}:{versiontag} -> {repopath}")
+            if mirror:
+                runner(f"cd {repopath} && git fetch {mirror} '+refs/heads/*:refs/remotes/origin/*' '+refs/tags/*:refs/tags/*'")
+            else:
+                runner(f"cd {repopath} && git fetch")
+            runner(f"cd {repopath} && git checkout {versiontag}")
+            # Only a branch has anything to rebase on to - a tag is checked out detached
+            if local(f"cd {repopath} && git symbolic-ref -q HEAD", hide=True, warn=True).ok:
+                try:
+                    # with a mirror origin/* is already up to date so just rebase on to it
+                    runner(f"cd {repopath} && " + ("git rebase" if mirror else "git pull --rebase"))
+                except Exception as exc:
+                    log("Rebase failed: ", traceback.format_exc())
+        elif mirror:
+            log(f"Cloning {repo_url}:{versiontag} -> {repopath} (from {mirror})")
+            runner(f"git clone {mirror} {repopath} && cd {repopath} && git remote set-url origin {repo_url}")
+        elif sha:
+            log(f"Cloning {repo_url}:{versiontag} -> {repopath} (shallow)")
+            runner(f"git init -q {repopath} && cd {repopath} && git remote add origin {repo_url} && git fetch --depth=1 origin {tagref}")
+        else:
+            log(f"Cloning {repo_url}:{versiontag} -> {repopath}")
+            runner(f"git clone {repo_url} {repopath}")
     if versiontag.lower() == "head": versiontag = default_main
-    runner(f"cd {repopath} && git checkout {versiontag or default_main}")
+    runner(f"cd {repopath} && git checkout {sha or versiontag or default_main}")
+
+# Runs a whole checkout on a host in one go.  Each step prints a "@@step <name> <exit code>" line
+# (preceded by its output if it failed) so the caller gets a structured per step status back.
+REMOTE_CHECKOUT_SCRIPT = """
+step() {
+  name=$1; shift
+  if out=$("$@" 2>&1); then rc=0; else rc=$?; printf '%s\\n' "$out"; fi
+  echo "@@step $name $rc"
+  return $rc
+}
+shallow_clone() {
+  git init -q "$1" && cd "$1" && git remote add origin "$2" && git fetch --depth=1 origin "$3"
+}
+# a package folder switched over to a snapshot (see snapshots.py) is a symlink to a tree without
+# a git repo - go back to the checkout it replaced if there is one, otherwise clone afresh
+if [ -L {repopath} ]; then
+  rm -f {repopath}
+  if [ -d {repopath}.pre-snapshot ]; then mv {repopath}.pre-snapshot {repopath}; fi
+fi
+if [ -d {repopath} ] && [ -n {sha} ]; then
+  cd {repopath} || exit 1
+  if [ "$(git rev-parse -q --verify HEAD)" = {sha} ]; then echo "@@step current 0"; exit 0; fi
+  if ! git cat-file -e {sha}^{commit} 2> /dev/null; then
+    depth=; [ "$(git rev-parse --is-shallow-repository)" = true ] && depth=--depth=1
+    step fetch git fetch $depth origin {tagref} || exit 1
+  fi
+elif [ -d {repopath} ]; then
+  cd {repopath} || exit 1
+  step fetch git fetch || exit 1
+  step checkout git checkout {branch} || exit 1
+  # only a branch has anything to rebase on to - a tag is checked out detached
+  if git symbolic-ref -q HEAD > /dev/null; then step pull git pull --rebase || true; fi
+elif [ -n {sha} ]; then
+  step clone shallow_clone {repopath} {repo_url} {tagref} || exit 1
+  cd {repopath} || exit 1
+else
+  step clone git clone {repo_url} {repopath} || exit 1
+  cd {repopath} || exit 1
+fi
+step checkout_final git checkout {finaltag}
+"""
+
+def parse_steps(output):
+    """ Parses the output of a REMOTE_CHECKOUT_SCRIPT into a list of {step, exit, output} dicts. """
+    steps, lines = [], []
+    for line in output.splitlines():
+        if line.startswith("@@step "):
+            _, name, code = line.split(" ", 2)
+            steps.append({"step": name, "exit": int(code), "output": "\n".join(lines)})
+            lines = []
+        else:
+            lines.append(line)
+    return steps
+
+def open_connections(group):
+    """ Opens (once) the ssh connection to each host in the group.  Every later command to a host is
+    then just a new channel on its already open connection.  Doing this before using the group
+    from several threads also avoids them racing to open the same connection. """
+    def connect(conn, log):
+        if not conn.is_connected: conn.open()
+    results = run_parallel(connect, list(group), len(group), key=lambda conn: conn.host, tag="host")
+    if report_failures("Connecting", results):
+        raise Exception("Could not connect to: " + ", ".join(r.key for r in results if not r.ok))
+
+def quote_remote_path(path):
+    """ shlex.quote for a path on a host that keeps a leading ~ (the remote user's home) working. """
+    if path == "~" or path.startswith("~/"):
+        return '"$HOME"' + (shlex.quote(path[1:]) if path[1:] else "")
+    if path.startswith("~"):
+        raise Exception(f"Only ~ (the remote user's home) is supported at the start of remote paths: {path}")
+    return shlex.quote(path)
+
+def sftp_path(path):
+    """ A path on a host for conn.put.  sftp does not expand ~ but resolves relative paths from the
+    remote user's home so a leading ~/ is dropped. """
+    if path == "~" or path.startswith("~/"): return path[2:] or "."
+    if path.startswith("~"):
+        raise Exception(f"Only ~ (the remote user's home) is supported at the start of remote paths: {path}")
+    return path
+
+def checkout_repo_remote(group, name, repo_url, versiontag, repodir, default_main="main", log=print, sha=""):
+    """ Checks out a repo on every host in the group with one command (the REMOTE_CHECKOUT_SCRIPT)
+    per host.  If sha is given hosts already at it do nothing and others only fetch if they do not
+    have it (see checkout_repo).  Returns a dict of host -> list of step statuses and raises if any
+    host failed. """
+    repopath = f"{repodir}/{name}"
+    # packages of an uncommitted version have no tag yet and follow the main branch
+    branch = default_main if versiontag.lower() in ("", "head") else versiontag
+    finaltag = sha or branch
+    tagref = f"+refs/tags/{versiontag}:refs/tags/{versiontag}"
+    script = REMOTE_CHECKOUT_SCRIPT
+    for key, value in (("{repopath}", repopath), ("{branch}", branch), ("{repo_url}", repo_url), ("{finaltag}", finaltag),
+                       ("{sha}", sha), ("{tagref}", tagref)):
+        script = script.replace(key, quote_remote_path(value) if key == "{repopath}" else shlex.quote(value))
+    log(f"Checking out {repo_url}:{versiontag} -> {repopath} on {len(group)} host(s)")
+    try:
+        results = group_run(group, f"bash -c {shlex.quote(script)}", hide=True, warn=True)
+    except GroupException as exc:
+        results = exc.result
+    statuses, failed = {}, []
+    for conn, res in results.items():
+        if isinstance(res, Exception):
+            statuses[conn.host] = [{"step": "connect", "exit": -1, "output": str(res)}]
+        else:
+            statuses[conn.host] = parse_steps(res.stdout)
+        steps = statuses[conn.host]
+        log(f"{conn.host}: " + ", ".join(f"{s['step']}={'ok' if s['exit'] == 0 else 'failed'}" for s in steps))
+        for s in steps:
+            if s["exit"] != 0 and s["output"]: log(s["output"])
+        if isinstance(res, Exception) or res.failed:
+            failed.append(conn.host)
+    if failed:
+        raise Exception(f"Checkout of {name} failed on: {', '.join(failed)}")
+    return statuses
 
 @task
 def ensure_certificate(ctx, domain, workdir, email):
     local(f"certbot -d {domain} --work-dir={workdir} --logs-dir={workdir}/logs --config-dir={workdir}/configs --manual --preferred-challenges dns certonly -m {email} --agree-tos")
 
+DOCKER_PACKAGES = ["docker.io", "docker-compose"]
+DOCKER_SYSCTLS = {"vm.max_map_count": 262144}
+
 @task
-def setup_docker(ctx, user, group=None):
+def setup_docker(ctx, user, group=None, jobs=DEFAULT_JOBS, facts=None):
+    """ Installs and configures docker on the hosts in the group.  Facts about each host are probed
+    (or taken from the FactCache `facts` if still fresh) and only the steps a host actually needs
+    are run on it, as one command, upto `jobs` hosts at a time.  Docker is only restarted on hosts
+    where it was just installed.  Returns a dict of host -> the commands that were run. """
     group = group or get_group(ctx)
-    group.run("sudo apt-get install -y docker.io")
-    group.run("sudo apt-get install -y docker-compose")
-    group.run("sudo sysctl -w vm.max_map_count=262144")
-    group.run("sudo systemctl restart docker")
-    try: group.run("sudo groupadd docker")
-    except: pass
-    group.run(f"sudo usermod -aG docker {user}")
+    facts = facts or FactCache()
+    probe = FactProbe(packages=DOCKER_PACKAGES, sysctls=DOCKER_SYSCTLS, groups=["docker"], users=[user])
+
+    def setup_host(conn, log):
+        hostfacts = facts.get(conn, probe, log)
+        cmds = []
+        missing = [p for p in DOCKER_PACKAGES if not hostfacts["packages"].get(p)]
+        if missing:
+            cmds.append(f"sudo apt-get install -y {' '.join(missing)}")
+        for key, value in DOCKER_SYSCTLS.items():
+            current = hostfacts["sysctls"].get(key, "")
+            if not current.isdigit() or int(current) < value:
+                cmds.append(f"sudo sysctl -w {key}={value}")
+        if missing:
+            cmds.append("sudo systemctl restart docker")
+        if not hostfacts["groups"].get("docker"):
+            cmds.append("sudo groupadd -f docker")
+        if "docker" not in hostfacts["usergroups"].get(user, []):
+            cmds.append(f"sudo usermod -aG docker {user}")
+        if not cmds:
+            log("Already set up")
+            return cmds
+        for cmd in cmds: log(cmd)
+        try:
+            remote(conn, " && ".join(cmds), hide=True)
+        finally:
+            facts.invalidate(conn.host, probe)
+        return cmds
+    results = run_parallel(setup_host, list(group), jobs, key=lambda conn: conn.host, tag="host")
+    if report_failures("Docker setup", results):
+        raise Exception("Docker setup failed on: " + ", ".join(r.key for r in results if not r.ok))
     print("Docker Setup complete")
+    return {r.key: r.value for r in results}
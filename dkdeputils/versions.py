@@ -1,6 +1,8 @@
 
-import typer, datetime
+import sys, typer, datetime
 from typing import List
+from dkdeputils.parallel import DEFAULT_JOBS
+from dkdeputils.rollout import DEFAULT_BATCH_SIZE, DEFAULT_MAX_IN_FLIGHT
 
 app = typer.Typer()
 
@@ -16,9 +18,10 @@ def new(ctx: typer.Context,
     return ctx.obj["manifest"].newversion(name, headname)
 
 @app.command()
-def commit(ctx: typer.Context):
+def commit(ctx: typer.Context,
+           jobs: int = typer.Option(DEFAULT_JOBS, "--jobs", "-j", help = "Maximum number of repos to work on concurrently")):
     """ Snapshots and commits the current (uncommitted) version and creates a new tag for it. """
-    return ctx.obj["manifest"].commitversion(ctx.obj["repodir"])
+    return ctx.obj["manifest"].commitversion(ctx.obj["repodir"], jobs, mirrors=ctx.obj["mirrors"])
 
 @app.command()
 def add_package(ctx: typer.Context,
@@ -36,10 +39,56 @@ def remove_nodes(ctx: typer.Context,
 
 @app.command()
 def checkout(ctx: typer.Context,
-             version: str = typer.Argument(..., help="Version of the deployment to checkout")):
-    ctx.obj["manifest"].checkout(version, ctx.obj["repodir"])
+             version: str = typer.Argument(..., help="Version of the deployment to checkout"),
+             jobs: int = typer.Option(DEFAULT_JOBS, "--jobs", "-j", help = "Maximum number of repos to checkout concurrently"),
+             hosts: str = typer.Option("", help = "Comma separated hosts to checkout on (over ssh) instead of locally"),
+             snapshots: bool = typer.Option(False, help = "Copy snapshots of the packages to the hosts instead of each host cloning the repos")):
+    """ Checks out all the repos of a version to the tags recorded in the manifest. """
+    if snapshots and not hosts:
+        print("--snapshots can only be used with --hosts (snapshots are distributed to hosts)")
+        sys.exit(1)
+    group = None
+    if hosts:
+        from fabric import ThreadingGroup
+        group = ThreadingGroup(*[h.strip() for h in hosts.split(",") if h.strip()])
+    ctx.obj["manifest"].checkout(version, ctx.obj["repodir"], group=group, jobs=jobs, mirrors=ctx.obj["mirrors"],
+                                 snapshots=ctx.obj["snapshots"] if snapshots else None)
+
+@app.command()
+def deploy(ctx: typer.Context,
+           version: str = typer.Argument(..., help="Version of the deployment to roll out"),
+           inventory: str = typer.Option("", "--inventory", "-i", envvar="DepToolsInventory", help = "Yaml file listing the hosts to deploy to"),
+           hosts: str = typer.Option("", help = "Comma separated hosts to deploy to (in addition to the inventory)"),
+           batch_size: int = typer.Option(DEFAULT_BATCH_SIZE, help = "Number of hosts in each wave"),
+           max_in_flight: int = typer.Option(DEFAULT_MAX_IN_FLIGHT, help = "Maximum number of hosts deployed to at the same time"),
+           max_failures: int = typer.Option(0, help = "Number of failed hosts beyond which the rollout is stopped"),
+           host_check: str = typer.Option("", help = "Command run on each host after it is deployed - the host fails if it fails"),
+           wave_check: str = typer.Option("", help = "Local command run after each wave (with the wave's hosts in $DKDEP_HOSTS) - the rollout stops if it fails"),
+           snapshots: bool = typer.Option(False, help = "Copy snapshots of the packages to the hosts instead of each host cloning the repos"),
+           jobs: int = typer.Option(DEFAULT_JOBS, "--jobs", "-j", help = "Maximum number of snapshots to build concurrently"),
+           report: str = typer.Option("", help = "Write the per host results as json to this file")):
+    """ Rolls a version out to a fleet of hosts in waves. """
+    from dkdeputils.rollout import load_inventory, parse_hosts
+    targets = (load_inventory(inventory) if inventory else []) + parse_hosts(hosts)
+    ctx.obj["manifest"].deploy(version, targets, ctx.obj["repodir"], batch_size, max_in_flight, max_failures,
+                               host_check, wave_check, ctx.obj["snapshots"] if snapshots else None, jobs, report)
+
+@app.command()
+def status(ctx: typer.Context,
+           version: str = typer.Argument("", help="Version to compare the checkouts against (the latest one by default)"),
+           jobs: int = typer.Option(DEFAULT_JOBS, "--jobs", "-j", help = "Maximum number of repos to inspect concurrently"),
+           as_json: bool = typer.Option(False, "--json", help = "Print the status as json")):
+    """ Shows which repos in the repodir are not at the commits a version expects or have local changes, without changing or fetching anything. """
+    ctx.obj["manifest"].status(version, ctx.obj["repodir"], jobs, as_json)
 
 @app.command()
 def describe(ctx: typer.Context,
              version: str = typer.Argument("", help="Describe a particular version of the deployment to checkout")):
     ctx.obj["manifest"].describe(version)
+
+@app.command()
+def with_package(ctx: typer.Context,
+                 pkgname: str = typer.Argument(..., help="Name of the package to look for"),
+                 tag: str = typer.Argument("", help="Only versions with the package at this version tag")):
+    """ Lists the versions of the deployment that contain a package. """
+    ctx.obj["manifest"].versions_with_package(pkgname, tag)
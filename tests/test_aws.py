@@ -0,0 +1,101 @@
+import io, unittest, contextlib
+from dkdeputils.aws import AWSClient, StubBackend, IngressRule, parse_port_range, permission_covered, ip_permissions, cli_to_api_params, aws_tag_spec
+
+class IngressRuleTest(unittest.TestCase):
+    def test_port_ranges(self):
+        self.assertEqual(parse_port_range(22), (22, 22))
+        self.assertEqual(parse_port_range("8000-8080"), (8000, 8080))
+        self.assertEqual(parse_port_range((1, 3)), (1, 3))
+
+    def test_atoms(self):
+        rule = IngressRule([22, "80-81"], cidrs=["10.0.0.0/8", "::/0"])
+        self.assertEqual(sorted(rule.atoms()), [
+            ("tcp", 22, 22, "10.0.0.0/8"), ("tcp", 22, 22, "::/0"),
+            ("tcp", 80, 81, "10.0.0.0/8"), ("tcp", 80, 81, "::/0")])
+
+    def test_all_protocols(self):
+        rule = IngressRule([22, 80], protocol="all")
+        self.assertEqual(rule.atoms(), [("-1", None, None, "0.0.0.0/0")])
+        self.assertEqual(IngressRule([53], protocol=17).protocol, "udp")
+
+class PermissionCoveredTest(unittest.TestCase):
+    existing = [
+        {"IpProtocol": "tcp", "FromPort": 8000, "ToPort": 9000, "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
+         "Ipv6Ranges": [{"CidrIpv6": "::/0"}]},
+        {"IpProtocol": "-1", "IpRanges": [{"CidrIp": "10.0.0.0/8"}]},
+    ]
+
+    def test_within_range(self):
+        self.assertTrue(permission_covered(self.existing, ("tcp", 8080, 8080, "0.0.0.0/0")))
+        self.assertTrue(permission_covered(self.existing, ("tcp", 8000, 9000, "0.0.0.0/0")))
+        self.assertFalse(permission_covered(self.existing, ("tcp", 7999, 8080, "0.0.0.0/0")))
+        self.assertFalse(permission_covered(self.existing, ("udp", 8080, 8080, "0.0.0.0/0")))
+
+    def test_ipv6(self):
+        self.assertTrue(permission_covered(self.existing, ("tcp", 8080, 8080, "::/0")))
+        self.assertFalse(permission_covered(self.existing, ("tcp", 22, 22, "::/0")))
+
+    def test_all_protocols(self):
+        self.assertTrue(permission_covered(self.existing, ("udp", 53, 53, "10.0.0.0/8")))
+        self.assertTrue(permission_covered(self.existing, ("-1", None, None, "10.0.0.0/8")))
+        self.assertFalse(permission_covered(self.existing, ("-1", None, None, "0.0.0.0/0")))
+        self.assertTrue(permission_covered([{"IpProtocol": "all", "IpRanges": [{"CidrIp": "1.2.3.4/32"}]}],
+                                           ("tcp", 22, 22, "1.2.3.4/32")))
+
+class IpPermissionsTest(unittest.TestCase):
+    def test_grouping(self):
+        perms = ip_permissions([("tcp", 22, 22, "0.0.0.0/0"), ("tcp", 22, 22, "::/0"),
+                                ("tcp", 80, 80, "0.0.0.0/0"), ("-1", None, None, "10.0.0.0/8")])
+        self.assertEqual(perms, [
+            {"IpProtocol": "-1", "IpRanges": [{"CidrIp": "10.0.0.0/8"}]},
+            {"IpProtocol": "tcp", "FromPort": 22, "ToPort": 22, "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
+             "Ipv6Ranges": [{"CidrIpv6": "::/0"}]},
+            {"IpProtocol": "tcp", "FromPort": 80, "ToPort": 80, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]},
+        ])
+
+class ReconcileIngressTest(unittest.TestCase):
+    def test_only_missing_permissions_are_authorized(self):
+        groups = {"SecurityGroups": [
+            {"GroupId": "sg-1", "IpPermissions": [{"IpProtocol": "tcp", "FromPort": 22, "ToPort": 22, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]}]},
+            {"GroupId": "sg-2", "IpPermissions": [{"IpProtocol": "-1", "IpRanges": [{"CidrIp": "0.0.0.0/0"}]}]},
+        ]}
+        client = AWSClient(None, backend=StubBackend({("ec2", "DescribeSecurityGroups"): groups}))
+        rules = [IngressRule([22, 443])]
+        with contextlib.redirect_stdout(io.StringIO()):
+            added = client.reconcile_ingress({"sg-1": rules, "sg-2": rules})
+        self.assertEqual(added["sg-1"], [{"IpProtocol": "tcp", "FromPort": 443, "ToPort": 443, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]}])
+        self.assertEqual(added["sg-2"], [])
+        authorized = [params for _, operation, params in client.backend.calls if operation == "AuthorizeSecurityGroupIngress"]
+        self.assertEqual(authorized, [{"GroupId": "sg-1", "IpPermissions": added["sg-1"]}])
+
+class CreationConfigTest(unittest.TestCase):
+    def test_cli_options(self):
+        params = cli_to_api_params({"--image-id": "ami-1", "--instance-type": "t3.micro", "--security-group-ids": "sg-1 sg-2",
+                                    "--tag-specifications": "ResourceType=instance,Tags=[{Key=Name,Value=web},{Key=env,Value=prod}]",
+                                    "--count": "1", "VolumeSize": 20})
+        self.assertEqual(params, {"ImageId": "ami-1", "InstanceType": "t3.micro", "SecurityGroupIds": ["sg-1", "sg-2"],
+                                  "TagSpecifications": [aws_tag_spec("instance", Name="web", env="prod")], "VolumeSize": 20})
+
+    def test_api_params_unchanged(self):
+        config = {"ImageId": "ami-1", "TagSpecifications": [aws_tag_spec("instance", Name="web")]}
+        self.assertEqual(cli_to_api_params(config), config)
+
+    def test_shorthand_is_rejected(self):
+        with self.assertRaisesRegex(Exception, "BlockDeviceMappings"):
+            cli_to_api_params({"--block-device-mapping": "DeviceName=/dev/sda1,Ebs={VolumeSize=10}"})
+
+    def test_launch_with_cli_options(self):
+        backend = StubBackend({
+            ("ec2", "DescribeImages"): {"Images": [{"BlockDeviceMappings": [{"DeviceName": "/dev/xvda"}]}]},
+            ("ec2", "RunInstances"): {"Instances": [{"InstanceId": "i-1", "State": {"Name": "running"}}]},
+        })
+        client = AWSClient(None, backend=backend)
+        with contextlib.redirect_stdout(io.StringIO()):
+            inst, created = client.ensure_instance(lambda inst: False, {"--image-id": "ami-1", "--instance-type": "t3.micro"})
+        self.assertTrue(created)
+        run = [params for _, operation, params in backend.calls if operation == "RunInstances"][0]
+        self.assertEqual(run["ImageId"], "ami-1")
+        self.assertEqual(run["BlockDeviceMappings"], [{"DeviceName": "/dev/xvda", "Ebs": {"VolumeSize": 100}}])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import os, sys, shutil, tempfile, unittest
+from dkdeputils.mirrors import MirrorCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic
+
+class MirrorCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.origin = synthetic.make_origin(os.path.join(self.tmpdir, "pkg.git"), commits=2)
+        self.root = os.path.join(self.tmpdir, "mirrors")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_mirror_in_use_is_not_evicted(self):
+        # flock locks belong to the open file so a second cache behaves like another process's
+        other = MirrorCache(self.root, max_size_mb=0)
+        with MirrorCache(self.root).using(self.origin, log=lambda *a: None) as path:
+            self.assertTrue(os.path.isdir(path))
+            self.assertEqual(other.evict(log=lambda *a: None), [])
+            self.assertTrue(os.path.isdir(path))
+        self.assertEqual(other.evict(log=lambda *a: None), [path])
+        self.assertFalse(os.path.isdir(path))
+
+    def test_evicted_mirror_is_recreated(self):
+        cache = MirrorCache(self.root)
+        path = cache.ensure(self.origin, log=lambda *a: None)
+        shutil.rmtree(path)
+        with cache.using(self.origin, log=lambda *a: None) as again:
+            self.assertEqual(again, path)
+            self.assertTrue(os.path.isdir(path))
+
+if __name__ == "__main__":
+    unittest.main()
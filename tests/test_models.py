@@ -0,0 +1,170 @@
+import os, sys, io, shutil, unittest, tempfile, contextlib
+from unittest import mock
+from dkdeputils.models import Manifest, Deployment, Version, Package, yamldump, yamlload
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic
+
+def version_json(versiontag, committed=True, **packages):
+    out = {"name": versiontag, "versiontag": versiontag,
+           "packages": [{"name": name, "repo_url": f"git@example.com:org/{name}", "versiontag": tag} for name, tag in packages.items()]}
+    if committed: out["created_at"] = 1.0
+    return out
+
+class DeploymentTest(unittest.TestCase):
+    def deployment(self):
+        return Deployment().from_json({"name": "dep", "versions": [
+            version_json("v1", a="a1", b="b1"), version_json("v2", a="a2", b="b1"), version_json("v3", committed=False, a="a2", b="b2")]})
+
+    def test_get_version(self):
+        d = self.deployment()
+        self.assertEqual(d.num_versions, 3)
+        self.assertEqual(d.get_version("v2").packages["a"].versiontag, "a2")
+        self.assertIsNone(d.get_version("v4"))
+        self.assertEqual(d.uncommitted_version.versiontag, "v3")
+
+    def test_remove_version(self):
+        d = self.deployment()
+        self.assertEqual(d.remove_version("v1").versiontag, "v1")
+        self.assertIsNone(d.remove_version("v1"))
+        self.assertIsNone(d.get_version("v1"))
+        self.assertEqual([v.versiontag for v in d.versions], ["v2", "v3"])
+        self.assertEqual(d.get_version("v3").versiontag, "v3")
+
+    def test_versions_with_package(self):
+        d = self.deployment()
+        self.assertEqual([v.versiontag for v in d.versions_with_package("b", "b1")], ["v1", "v2"])
+        self.assertEqual([v.versiontag for v in d.versions_with_package("b", "b2")], ["v3"])
+        d.remove_version("v1")
+        self.assertEqual([v.versiontag for v in d.versions_with_package("b", "b1")], ["v2"])
+        d.add_version(Version("v4", packages={"b": Package("b", "git@example.com:org/b", "b1")}))
+        self.assertEqual([v.versiontag for v in d.versions_with_package("b", "b1")], ["v2", "v4"])
+
+    def test_duplicate_versiontags(self):
+        d = Deployment().from_json({"name": "dep", "versions": [
+            version_json("v1", a="first"), version_json("v2", a="a2"), version_json("v1", a="second")]})
+        self.assertEqual(d.num_versions, 3)
+        self.assertEqual(d.get_version("v1").packages["a"].versiontag, "first")
+        self.assertEqual(len(d.to_json()["versions"]), 3)
+        d.remove_version("v1")
+        self.assertEqual(d.get_version("v1").packages["a"].versiontag, "second")
+        with self.assertRaises(Exception):
+            d.add_version(Version("v2"))
+
+    def test_clone_shares_records(self):
+        d1, d2 = self.deployment(), self.deployment()
+        self.assertIs(d1.get_version("v1").packages["a"], d2.get_version("v1").packages["a"])
+        d1.remove_version("v3")
+        d2.remove_version("v3")
+        v4, v5 = d1.new_version("v4"), d2.new_version("v5")
+        self.assertIs(v4.packages["a"], v5.packages["a"])
+        self.assertEqual(v4.packages["a"].versiontag, "")
+        self.assertIsNot(v4.packages["a"], d1.get_version("v2").packages["a"])
+
+    def test_new_version(self):
+        d = Deployment().from_json({"name": "dep", "versions": [version_json("v1", a="a1")]})
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(d.new_version("v1"))
+        v2 = d.new_version("v2")
+        self.assertIs(d.new_version("v3"), v2)      # the uncommitted version is reused
+        self.assertEqual(v2.packages["a"].versiontag, "")
+
+class ManifestBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "manifest")
+        with open(self.path, "w") as outfile:
+            outfile.write(yamldump({"name": "dep", "versions": [version_json("v1", committed=False)]}))
+        self.manifest = Manifest(self.path, None)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self):
+        with open(self.path) as infile: return yamlload(infile.read())
+
+    def test_single_write(self):
+        with mock.patch.object(Manifest, "write", autospec=True, side_effect=Manifest.write) as write:
+            with self.manifest.batch():
+                self.manifest.addpkg("a", "git@example.com:org/a")
+                self.manifest.addpkg("b", "git@example.com:org/b")
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual([p["name"] for p in self.read()["versions"][0]["packages"]], ["a", "b"])
+
+    def test_nothing_written_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.manifest.batch():
+                self.manifest.addpkg("a", "git@example.com:org/a")
+                raise RuntimeError()
+        self.assertEqual(self.read()["versions"][0]["packages"], [])
+        # and the next mutation is written straight away
+        self.manifest.addpkg("b", "git@example.com:org/b")
+        self.assertEqual([p["name"] for p in self.read()["versions"][0]["packages"]], ["b"])
+
+    def test_reloads_when_starting(self):
+        other = Manifest(self.path, None)
+        other.addpkg("a", "git@example.com:org/a")
+        with self.manifest.batch():
+            self.manifest.addpkg("b", "git@example.com:org/b")
+        self.assertEqual([p["name"] for p in self.read()["versions"][0]["packages"]], ["a", "b"])
+
+class CommitVersionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.origins = {name: os.path.join(self.tmpdir, f"{name}.git") for name in ("a", "b")}
+        packages = [{"name": name, "repo_url": synthetic.make_origin(path, commits=2), "versiontag": "main"}
+                    for name, path in self.origins.items()]
+        self.path = os.path.join(self.tmpdir, "manifest")
+        with open(self.path, "w") as outfile:
+            outfile.write(yamldump({"name": "dep", "versions": [{"name": "v1", "versiontag": "v1", "packages": packages}]}))
+        self.repodir = os.path.join(self.tmpdir, "repos")
+        env = mock.patch.dict(os.environ, synthetic.GIT_ENV)
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def commit(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            Manifest(self.path, None).commitversion(self.repodir, jobs=2)
+
+    def tags(self, repopath):
+        return synthetic.git(repopath, "tag", "-l").split()
+
+    def test_tags_pushed(self):
+        self.commit()
+        version = Manifest(self.path, None).deployment.get_version("v1")
+        self.assertTrue(version.created_at)
+        for name, origin in self.origins.items():
+            pkg = version.packages[name]
+            self.assertEqual(self.tags(origin), [pkg.versiontag])
+            self.assertEqual(synthetic.git(origin, "rev-parse", f"{pkg.versiontag}^{{commit}}"), pkg.sha)
+
+    def test_unchanged_packages_share_records(self):
+        self.commit()
+        synthetic.push_commit(self.origins["a"], 2)
+        manifest = Manifest(self.path, None)
+        manifest.newversion("v2")
+        with contextlib.redirect_stdout(io.StringIO()):
+            manifest.commitversion(self.repodir, jobs=2)
+        v1, v2 = manifest.deployment.get_version("v1"), manifest.deployment.get_version("v2")
+        self.assertIs(v2.packages["b"], v1.packages["b"])
+        self.assertNotEqual(v2.packages["a"].versiontag, v1.packages["a"].versiontag)
+        self.assertEqual(self.tags(self.origins["b"]), [v1.packages["b"].versiontag])
+
+    def test_failed_push_is_rolled_back(self):
+        hook = os.path.join(self.origins["b"], "hooks", "pre-receive")
+        with open(hook, "w") as outfile: outfile.write("#!/bin/sh\nexit 1\n")
+        os.chmod(hook, 0o755)
+        with open(self.path) as infile: before = infile.read()
+        with self.assertRaises(SystemExit) as cm:
+            self.commit()
+        self.assertEqual(cm.exception.code, 1)
+        for name, origin in self.origins.items():
+            self.assertEqual(self.tags(origin), [])
+            self.assertEqual(self.tags(os.path.join(self.repodir, name)), [])
+        with open(self.path) as infile: self.assertEqual(infile.read(), before)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import io, time, unittest, threading, contextlib
+from unittest import mock
+from dkdeputils.models import Version
+from dkdeputils.rollout import rollout, parse_hosts, waves
+
+class FakeConnection:
+    """ Stands in for fabric's Connection.  Health checks (conn.run) fail on hosts named bad*. """
+    def __init__(self, host, user=None, port=None):
+        self.host = host
+
+    def run(self, cmd, **kwargs):
+        if self.host.startswith("bad"): raise Exception(f"{cmd} failed on {self.host}")
+
+    def close(self): pass
+
+class RolloutTest(unittest.TestCase):
+    def setUp(self):
+        self.deployed = []
+        self.in_flight = self.max_in_flight = 0
+        self.lock = threading.Lock()
+        for target, value in (("fabric.Connection", FakeConnection), ("dkdeputils.snapshots.install_snapshots", self.install)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def install(self, conn, snapshots, repodir, log):
+        """ The stubbed per host deploy: fails on hosts named fail* and tracks how many run at once. """
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+            self.deployed.append(conn.host)
+        if conn.host.startswith("fail"): raise Exception(f"install failed on {conn.host}")
+        return {"pkg": "uploaded"}
+
+    def rollout(self, hosts, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            results, completed = rollout(Version("v1"), parse_hosts(hosts), "/repos", snapshots=["snapshot"], **kwargs)
+        return {r.host: (r.wave, r.status) for r in results}, completed
+
+    def test_waves(self):
+        self.assertEqual(waves([1, 2, 3, 4, 5], 2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(waves([1, 2], 0), [[1, 2]])
+        results, completed = self.rollout("h1,h2,h3,h4,h5,h1", batch_size=2, max_in_flight=2)
+        self.assertTrue(completed)
+        self.assertEqual(results, {"h1": (1, "ok"), "h2": (1, "ok"), "h3": (2, "ok"), "h4": (2, "ok"), "h5": (3, "ok")})
+        self.assertEqual(self.deployed[-1], "h5")
+
+    def test_max_in_flight(self):
+        results, completed = self.rollout(",".join(f"h{i}" for i in range(8)), batch_size=8, max_in_flight=3)
+        self.assertTrue(completed)
+        self.assertEqual(len(self.deployed), 8)
+        self.assertLessEqual(self.max_in_flight, 3)
+        self.assertGreater(self.max_in_flight, 1)
+
+    def test_stops_after_max_failures(self):
+        results, completed = self.rollout("h1,fail2,h3,h4", batch_size=2, max_in_flight=1)
+        self.assertFalse(completed)
+        self.assertEqual(results, {"h1": (1, "ok"), "fail2": (1, "failed"), "h3": (2, "skipped"), "h4": (2, "skipped")})
+        self.assertNotIn("h3", self.deployed)
+
+    def test_failures_within_limit(self):
+        results, completed = self.rollout("fail1,h2,bad3,h4", batch_size=2, max_in_flight=1, max_failures=2, host_check="true")
+        self.assertTrue(completed)
+        self.assertEqual([status for _, status in results.values()], ["failed", "ok", "failed", "ok"])
+
+    def test_stops_when_wave_check_fails(self):
+        check = 'test "$DKDEP_WAVE" = 1 && test "$DKDEP_HOSTS" = "h1 h2" && exit 1'
+        results, completed = self.rollout("h1,h2,h3", batch_size=2, wave_check=check)
+        self.assertFalse(completed)
+        self.assertEqual(results, {"h1": (1, "ok"), "h2": (1, "ok"), "h3": (2, "skipped")})
+
+if __name__ == "__main__":
+    unittest.main()
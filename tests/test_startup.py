@@ -0,0 +1,19 @@
+""" Checks that the dkdep commands in benchmarks/startup.py do not import heavy dependencies.  The
+timing part of that check depends on the machine so it is only run by `make test-startup`. """
+import os, sys, tempfile, unittest
+
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOTDIR, "benchmarks"))
+
+import startup
+
+class StartupTest(unittest.TestCase):
+    def test_no_heavy_imports(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env, commands = startup.prepare(tmpdir)
+            for name, args in commands.items():
+                with self.subTest(command=name):
+                    self.assertEqual(startup.heavy_imports(args, env), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os, sys, io, shutil, tempfile, unittest, subprocess, contextlib
+from dkdeputils.utils import parse_steps, quote_remote_path, sftp_path, checkout_repo_remote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic
+
+class LocalResult:
+    def __init__(self, proc):
+        self.stdout, self.stderr, self.exited = proc.stdout, proc.stderr, proc.returncode
+        self.failed = proc.returncode != 0
+
+class LocalHost:
+    """ Stands in for a fabric Connection by running commands locally with home as $HOME. """
+    def __init__(self, host, home):
+        self.host = host
+        self.home = home
+
+    def run(self, cmd, hide=None, warn=False):
+        proc = subprocess.run(cmd, shell=True, capture_output=True, text=True, executable="/bin/bash", cwd=self.home,
+                              env=dict(os.environ, HOME=self.home, **synthetic.GIT_ENV))
+        return LocalResult(proc)
+
+class LocalGroup(list):
+    def run(self, cmd, **kwargs):
+        return {conn: conn.run(cmd, **kwargs) for conn in self}
+
+class ParseStepsTest(unittest.TestCase):
+    def test_steps_and_output(self):
+        output = "\n".join([
+            "Fetching origin",
+            "@@step fetch 0",
+            "error: pathspec 'v9' did not match",
+            "second line",
+            "@@step checkout 1",
+        ])
+        self.assertEqual(parse_steps(output), [
+            {"step": "fetch", "exit": 0, "output": "Fetching origin"},
+            {"step": "checkout", "exit": 1, "output": "error: pathspec 'v9' did not match\nsecond line"},
+        ])
+
+    def test_trailing_output_and_empty(self):
+        self.assertEqual(parse_steps(""), [])
+        self.assertEqual(parse_steps("@@step clone 0\nleftover"), [{"step": "clone", "exit": 0, "output": ""}])
+
+class RemotePathTest(unittest.TestCase):
+    def test_home(self):
+        self.assertEqual(quote_remote_path("~"), '"$HOME"')
+        self.assertEqual(quote_remote_path("~/repos"), '"$HOME"/repos')
+        self.assertEqual(quote_remote_path("~/my repos"), '"$HOME"\'/my repos\'')
+        self.assertEqual(sftp_path("~/repos/a.tar.gz"), "repos/a.tar.gz")
+        self.assertEqual(sftp_path("~"), ".")
+
+    def test_other_paths(self):
+        self.assertEqual(quote_remote_path("/opt/my repos"), "'/opt/my repos'")
+        self.assertEqual(sftp_path("/opt/repos"), "/opt/repos")
+        with self.assertRaises(Exception):
+            quote_remote_path("~deploy/repos")
+
+class CheckoutRepoRemoteTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.origin = synthetic.make_origin(os.path.join(self.tmpdir, "pkg.git"), commits=2)
+        home = os.path.join(self.tmpdir, "h1")
+        os.makedirs(home)
+        self.group = LocalGroup([LocalHost("h1", home)])
+        self.repopath = os.path.join(home, "repos", "pkg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def checkout(self, versiontag, sha=""):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return checkout_repo_remote(self.group, "pkg", self.origin, versiontag, "~/repos", log=print, sha=sha)
+
+    def head(self):
+        return synthetic.git(self.repopath, "rev-parse", "HEAD")
+
+    def test_untagged_package_follows_main(self):
+        # packages of an uncommitted version have an empty versiontag
+        self.assertEqual([s["step"] for s in self.checkout("")["h1"]], ["clone", "checkout_final"])
+        synthetic.push_commit(os.path.join(self.tmpdir, "pkg.git"), 2)
+        steps = self.checkout("")["h1"]
+        self.assertEqual([s["step"] for s in steps], ["fetch", "checkout", "pull", "checkout_final"])
+        self.assertEqual(self.head(), synthetic.git(os.path.join(self.tmpdir, "pkg.git"), "rev-parse", "main"))
+
+    def test_pinned_sha(self):
+        self.checkout("")
+        sha = self.head()
+        self.assertEqual([s["step"] for s in self.checkout("v1", sha)["h1"]], ["current"])
+
+    def test_snapshot_folder_is_replaced(self):
+        # a host that had a snapshot installed (see snapshots.py) has a symlink to a tree without a repo
+        snapshot = os.path.join(os.path.dirname(self.repopath), ".dkdep-snapshots", "pkg@tree")
+        os.makedirs(snapshot)
+        os.symlink(snapshot, self.repopath)
+        self.assertEqual([s["step"] for s in self.checkout("")["h1"]], ["clone", "checkout_final"])
+        self.assertFalse(os.path.islink(self.repopath))
+
+    def test_checkout_before_snapshot_is_restored(self):
+        self.checkout("")
+        os.rename(self.repopath, self.repopath + ".pre-snapshot")
+        os.symlink(self.tmpdir, self.repopath)
+        self.assertEqual([s["step"] for s in self.checkout("")["h1"]], ["fetch", "checkout", "pull", "checkout_final"])
+        self.assertFalse(os.path.islink(self.repopath))
+
+if __name__ == "__main__":
+    unittest.main()